@@ -0,0 +1,414 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+import uuid
+
+from telegram import Bot
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
+
+import alerts
+import database
+import metrics
+import settings
+from dead_chats import DeadChats, is_permanent_failure
+from subscriptions import SubscriptionIndex, push_subscription
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+# How often the outbox is checked when nothing wakes the worker up
+POLL_INTERVAL = 5
+
+# How long a worker may hold a delivery before it is handed out again
+LEASE_TIME = 5 * 60
+
+ALERT_MESSAGES = metrics.Counter("bot_alert_messages_total", "Telegram messages sent for alerts")
+
+ALERT_DELIVERIES = metrics.Counter(
+    "bot_alert_deliveries_total", "Alert deliveries to a chat by how they ended", ("outcome",)
+)
+
+ALERT_SEND_LATENCY = metrics.Histogram("bot_alert_send_seconds", "Time to send one alert message")
+
+
+def alert_chunks(alerts_group, parse_mode: str) -> list:
+    """Returns the (part, job_ids, part_no, last) messages left to send of the alerts.
+
+    Overlong alerts continue in further messages, and count as delivered
+    once their last part is sent. Parts sent before a failed attempt are
+    skipped on the retry.
+    """
+    chunks = []
+    for (message, _, parts_sent), job_ids in alerts_group:
+        # Formatted alerts are never split, a cut could fall inside an entity
+        parts = alerts.split_message(message) if parse_mode is None else [message]
+        for part_no, part in enumerate(parts[parts_sent:], start=parts_sent + 1):
+            chunks.append((part, job_ids, part_no, part_no == len(parts)))
+    return chunks
+
+
+class AlertOutbox:
+    """Durable queue of alert deliveries, one row per job and chat.
+
+    Jobs are written by the HTTP endpoint and drained by a worker task on
+    the bot's event loop, so accepted alerts survive restarts and crashes.
+    Alerts to the same chat within ALERT_DIGEST_WINDOW are sent as one digest.
+    """
+
+    def __init__(self, dead_chats: DeadChats, subscriptions: SubscriptionIndex):
+        self.dead_chats = dead_chats
+        self.subscriptions = subscriptions
+        self.db = database.connect()
+        self.lock = threading.Lock()
+        self.loop = None
+        self.wakeup = None
+        self.stopping = False
+        with self.lock, self.db:
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS alert_jobs (
+                    id TEXT PRIMARY KEY,
+                    message TEXT NOT NULL,
+                    parse_mode TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS alert_deliveries (
+                    job_id TEXT NOT NULL REFERENCES alert_jobs (id),
+                    chat_id INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    error TEXT,
+                    parts_sent INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (job_id, chat_id)
+                );
+                CREATE INDEX IF NOT EXISTS alert_deliveries_due
+                    ON alert_deliveries (status, next_attempt_at);
+                """
+            )
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(alert_jobs)")]
+            if "parse_mode" not in columns:
+                self.db.execute("ALTER TABLE alert_jobs ADD COLUMN parse_mode TEXT")
+            # Parts of an overlong alert already delivered, so a retry doesn't repeat them
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(alert_deliveries)")]
+            if "parts_sent" not in columns:
+                self.db.execute("ALTER TABLE alert_deliveries ADD COLUMN parts_sent INTEGER NOT NULL DEFAULT 0")
+
+    def enqueue(self, message: str, chat_ids: list, parse_mode: str = None) -> str:
+        """Stores an alert for delivery and returns its job ID. Thread safe."""
+        return self.enqueue_many([(message, chat_ids, parse_mode)])[0]
+
+    def enqueue_many(self, entries: list) -> list:
+        """Stores (message, chat_ids, parse_mode) alerts in one transaction.
+
+        Returns the job IDs in the order of entries. Thread safe.
+        """
+        job_ids = [uuid.uuid4().hex for _ in entries]
+        now = time.time()
+        # Alerts wait out the digest window so later ones can join them
+        send_at = now + settings.ALERT_DIGEST_WINDOW
+        deliveries = []
+        for job_id, (_, chat_ids, _) in zip(job_ids, entries):
+            for chat_id in chat_ids:
+                chat_id = self.dead_chats.resolve(chat_id)
+                reason = self.dead_chats.reason(chat_id)
+                # Skip chats that are known to be unreachable
+                if reason is None:
+                    deliveries.append((job_id, chat_id, PENDING, send_at, None))
+                else:
+                    deliveries.append((job_id, chat_id, FAILED, send_at, reason))
+
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO alert_jobs (id, message, parse_mode, created_at) VALUES (?, ?, ?, ?)",
+                [
+                    (job_id, message, parse_mode, now)
+                    for job_id, (message, _, parse_mode) in zip(job_ids, entries)
+                ],
+            )
+            self.db.executemany(
+                """
+                INSERT OR IGNORE INTO alert_deliveries
+                    (job_id, chat_id, status, next_attempt_at, error)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                deliveries,
+            )
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return job_ids
+
+    def job_status(self, job_id: str):
+        with self.lock:
+            job = self.db.execute(
+                "SELECT created_at FROM alert_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            rows = self.db.execute(
+                """
+                SELECT chat_id, status, attempts, error FROM alert_deliveries
+                WHERE job_id = ? ORDER BY rowid
+                """,
+                (job_id,),
+            ).fetchall()
+
+        counts = {PENDING: 0, SENDING: 0, SENT: 0, FAILED: 0}
+        deliveries = []
+        for chat_id, status, attempts, error in rows:
+            counts[status] += 1
+            deliveries.append(
+                {"chat_id": chat_id, "status": status, "attempts": attempts, "error": error}
+            )
+        return {
+            "job_id": job_id,
+            "created_at": job[0],
+            "counts": counts,
+            "deliveries": deliveries,
+        }
+
+    def claim_due_chats(self, limit: int) -> list:
+        """Returns the deliveries of chats that have one due, leased to the caller.
+
+        With a digest window, all alerts waiting for a chat are claimed
+        together. Chats with a delivery still leased are skipped, so a chat
+        is only sent to by one worker at a time and in order. A delivery
+        whose worker dies without updating it becomes due again once the
+        lease runs out.
+        """
+        now = time.time()
+        claimed = []
+        with self.lock, self.db:
+            chat_ids = self.db.execute(
+                """
+                SELECT chat_id FROM alert_deliveries
+                WHERE status IN (?, ?) AND next_attempt_at <= ? AND chat_id NOT IN (
+                    SELECT chat_id FROM alert_deliveries WHERE status = ? AND next_attempt_at > ?
+                )
+                GROUP BY chat_id ORDER BY MIN(next_attempt_at)
+                LIMIT ?
+                """,
+                (PENDING, SENDING, now, SENDING, now, limit),
+            ).fetchall()
+            for (chat_id,) in chat_ids:
+                rows = self.db.execute(
+                    f"""
+                    SELECT job_id, attempts, message, parse_mode, parts_sent
+                    FROM alert_deliveries JOIN alert_jobs ON alert_jobs.id = alert_deliveries.job_id
+                    WHERE chat_id = ? AND (
+                        (status IN (?, ?) AND next_attempt_at <= ?)
+                        OR (? AND status = ? AND attempts = 0)
+                    )
+                    ORDER BY created_at
+                    {"" if settings.ALERT_DIGEST_WINDOW else "LIMIT 1"}
+                    """,
+                    (chat_id, PENDING, SENDING, now, bool(settings.ALERT_DIGEST_WINDOW), PENDING),
+                ).fetchall()
+                self.db.executemany(
+                    """
+                    UPDATE alert_deliveries SET status = ?, next_attempt_at = ?
+                    WHERE job_id = ? AND chat_id = ?
+                    """,
+                    [(SENDING, now + LEASE_TIME, job_id, chat_id) for job_id, *_ in rows],
+                )
+                claimed.append((chat_id, rows))
+        return claimed
+
+    def next_attempt_in(self) -> float:
+        # Alerts to a chat being sent to wait for that delivery, which wakes the worker up
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                """
+                SELECT MIN(next_attempt_at) FROM alert_deliveries
+                WHERE status = ? OR (status = ? AND chat_id NOT IN (
+                    SELECT chat_id FROM alert_deliveries WHERE status = ? AND next_attempt_at > ?
+                ))
+                """,
+                (SENDING, PENDING, SENDING, now),
+            ).fetchone()
+        if row[0] is None:
+            return POLL_INTERVAL
+        return min(POLL_INTERVAL, max(0.0, row[0] - time.time()))
+
+    def update_deliveries(self, chat_id: int, job_ids: list, **fields):
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self.lock, self.db:
+            self.db.executemany(
+                f"UPDATE alert_deliveries SET {columns} WHERE job_id = ? AND chat_id = ?",
+                [(*fields.values(), job_id, chat_id) for job_id in job_ids],
+            )
+
+    async def deliver(self, bot: Bot, chat_id: int, rows: list):
+        """Sends the claimed alerts of a chat as one digest, split to fit Telegram's limit."""
+        attempts = max(row[1] for row in rows) + 1
+        unsent = [row[0] for row in rows]
+
+        # Repeated alert bodies are delivered with their first copy
+        job_ids_by_alert = {}
+        for job_id, _, message, parse_mode, parts_sent in rows:
+            job_ids_by_alert.setdefault((message, parse_mode, parts_sent), []).append(job_id)
+
+        # Alerts with different parse modes can't share a message
+        for parse_mode, alerts_group in itertools.groupby(
+            job_ids_by_alert.items(), key=lambda item: item[0][1]
+        ):
+            chunks = alert_chunks(alerts_group, parse_mode)
+            for text, indices in alerts.pack_digest([chunk[0] for chunk in chunks]):
+                job_ids = [job_id for idx in indices if chunks[idx][3] for job_id in chunks[idx][1]]
+                started = time.perf_counter()
+                try:
+                    await alerts.send_alert_message(bot, chat_id, text, parse_mode)
+                except TelegramError as e:
+                    await self.handle_send_error(chat_id, unsent, attempts, e)
+                    return
+
+                ALERT_SEND_LATENCY.observe(time.perf_counter() - started)
+                ALERT_MESSAGES.inc()
+                for idx in indices:
+                    _, part_job_ids, part_no, last = chunks[idx]
+                    if not last:
+                        self.update_deliveries(chat_id, part_job_ids, parts_sent=part_no)
+                if job_ids:
+                    ALERT_DELIVERIES.inc(SENT, amount=len(job_ids))
+                    self.update_deliveries(
+                        chat_id, job_ids, status=SENT, attempts=attempts, error=None
+                    )
+                    unsent = [job_id for job_id in unsent if job_id not in job_ids]
+
+    async def handle_send_error(self, chat_id: int, job_ids: list, attempts: int, error: TelegramError):
+        """Retries, fails or reroutes the chat's unsent alerts depending on why sending failed."""
+        if isinstance(error, ChatMigrated):
+            self.migrate(chat_id, error.new_chat_id)
+        elif isinstance(error, RetryAfter):
+            delay = alerts.retry_after_seconds(error)
+            logger.warning(f"Alerts to {chat_id} flood limited for {delay}s")
+            self.retry(chat_id, job_ids, attempts, delay, error)
+        # BadRequest is a NetworkError too, but retrying won't fix it
+        elif isinstance(error, (BadRequest, Forbidden)):
+            if is_permanent_failure(error):
+                await self.prune(chat_id, error)
+            else:
+                self.fail(chat_id, job_ids, attempts, error)
+        # Connection problems and timeouts are worth retrying with backoff
+        elif isinstance(error, NetworkError) and attempts < settings.ALERT_MAX_ATTEMPTS:
+            delay = settings.ALERT_RETRY_DELAY * 2 ** (attempts - 1)
+            self.retry(chat_id, job_ids, attempts, delay, error)
+        else:
+            self.fail(chat_id, job_ids, attempts, error)
+
+    def retry(self, chat_id: int, job_ids: list, attempts: int, delay: float, error: Exception):
+        logger.warning(f"Alerts to {chat_id} failed, retrying in {delay}s: {str(error)}")
+        ALERT_DELIVERIES.inc("retried", amount=len(job_ids))
+        self.update_deliveries(
+            chat_id,
+            job_ids,
+            status=PENDING,
+            attempts=attempts,
+            next_attempt_at=time.time() + delay,
+            error=str(error),
+        )
+
+    def migrate(self, old_chat_id: int, new_chat_id: int):
+        """Moves the chat's unsent alerts over to the supergroup it became."""
+        self.dead_chats.migrate(old_chat_id, new_chat_id)
+        self.subscriptions.migrate(old_chat_id, new_chat_id)
+        with self.lock, self.db:
+            self.db.execute(
+                """
+                UPDATE OR IGNORE alert_deliveries
+                SET chat_id = ?, status = ?, next_attempt_at = ?, parts_sent = 0
+                WHERE chat_id = ? AND status IN (?, ?)
+                """,
+                (new_chat_id, PENDING, time.time(), old_chat_id, PENDING, SENDING),
+            )
+            # Left over when the new chat already had the same alert queued
+            self.db.execute(
+                "UPDATE alert_deliveries SET status = ?, error = ? WHERE chat_id = ? AND status IN (?, ?)",
+                (SENT, f"Migrated to {new_chat_id}", old_chat_id, PENDING, SENDING),
+            )
+
+    async def prune(self, chat_id: int, error: TelegramError):
+        """Stops delivering to a chat that blocked or removed the bot."""
+        self.dead_chats.mark_dead(chat_id, str(error))
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE alert_deliveries SET status = ?, error = ? WHERE chat_id = ? AND status IN (?, ?)",
+                (FAILED, str(error), chat_id, PENDING, SENDING),
+            )
+        # Tells Tarjoushaukka to stop sending alerts to the chat
+        self.subscriptions.unsubscribe(chat_id)
+        await push_subscription(self.subscriptions, chat_id)
+
+    def fail(self, chat_id: int, job_ids: list, attempts: int, error: Exception):
+        logger.warning(f"Alerts to {chat_id} failed: {str(error)}")
+        ALERT_DELIVERIES.inc(FAILED, amount=len(job_ids))
+        self.update_deliveries(
+            chat_id, job_ids, status=FAILED, attempts=attempts, error=str(error)
+        )
+
+    def stop(self):
+        """Makes run() stop taking new deliveries and return once the current ones are done."""
+        self.stopping = True
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def deliver_logged(self, bot: Bot, chat_id: int, rows: list):
+        try:
+            await self.deliver(bot, chat_id, rows)
+        except Exception:
+            logger.exception(f"Alerts to {chat_id} crashed")
+        finally:
+            # Retries may have been scheduled earlier than the worker expects
+            self.wakeup.set()
+
+    async def wait_for_work(self):
+        """Sleeps until new work arrives or a retry is due."""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=self.next_attempt_in())
+        except TimeoutError:
+            pass
+
+    async def run(self, bot: Bot):
+        """Drains the outbox until stopped or cancelled."""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        tasks = set()
+
+        try:
+            while not self.stopping:
+                free = settings.ALERT_CONCURRENCY - len(tasks)
+                for chat_id, rows in self.claim_due_chats(free):
+                    task = asyncio.create_task(self.deliver_logged(bot, chat_id, rows))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if len(tasks) >= settings.ALERT_CONCURRENCY:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                self.wakeup.clear()
+                if not self.stopping:
+                    await self.wait_for_work()
+
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            # Unfinished deliveries stay pending and are retried after restart
+            for task in tasks:
+                task.cancel()
+            self.loop = None
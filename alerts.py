@@ -0,0 +1,90 @@
+import datetime
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from tg_builder import background_messages
+
+# Telegram message limit is 4096 characters
+MAX_MESSAGE_LENGTH = 4096
+
+DIGEST_SEPARATOR = "\n\n― ― ―\n\n"
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return retry_after
+
+
+async def send_alert_message(bot: Bot, chat_id: int, text: str, parse_mode: str = None):
+    # Rate limited by the bot's TGRequest, behind the bot's replies
+    with background_messages():
+        return await bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=True,
+        )
+
+
+def utf16_length(text: str) -> int:
+    # Telegram counts message length in UTF-16 code units
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_long_line(line: str, limit: int) -> list:
+    pieces = []
+    piece, length = "", 0
+    for char in line:
+        char_length = 2 if ord(char) > 0xFFFF else 1
+        if length + char_length > limit:
+            pieces.append(piece)
+            piece, length = "", 0
+        piece += char
+        length += char_length
+    pieces.append(piece)
+    return pieces
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """Splits text into messages within Telegram's limit, at line boundaries where possible."""
+    if utf16_length(text) <= limit:
+        return [text]
+
+    parts = []
+    lines, length = [], 0
+    for line in text.split("\n"):
+        pieces = [line] if utf16_length(line) <= limit else split_long_line(line, limit)
+        for piece in pieces:
+            # Joining to the previous line costs a newline
+            added = utf16_length(piece) + (1 if lines else 0)
+            if lines and length + added > limit:
+                parts.append("\n".join(lines))
+                lines, length = [piece], utf16_length(piece)
+            else:
+                lines.append(piece)
+                length += added
+    if lines:
+        parts.append("\n".join(lines))
+    return parts
+
+
+def pack_digest(messages: list) -> list:
+    """Joins messages in order into as few Telegram messages as possible.
+
+    Returns (text, indices) tuples where indices point into messages.
+    """
+    parts = []
+    text, indices = "", []
+    for idx, message in enumerate(messages):
+        joined = text + DIGEST_SEPARATOR + message if indices else message
+        if indices and utf16_length(joined) > MAX_MESSAGE_LENGTH:
+            parts.append((text, indices))
+            text, indices = message, [idx]
+        else:
+            text, indices = joined, indices + [idx]
+    if indices:
+        parts.append((text, indices))
+    return parts
@@ -21,25 +21,34 @@
 """  # noqa
 
 import asyncio
-import json
+import contextlib
+import functools
+import logging
+import pathlib
 import random
+import secrets
 import threading
-import urllib
+import urllib.parse
 from dataclasses import dataclass
 from logging.config import dictConfig
 
+import httpx
 import jwt
-import requests
 import sentry_sdk
+import uvicorn
 from bs4 import BeautifulSoup
-from flask import Flask, request, Response
-from sentry_sdk.integrations.flask import FlaskIntegration
+from sentry_sdk.integrations.starlette import StarletteIntegration
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InlineQueryResultPhoto,
     Update,
 )
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
@@ -49,9 +58,32 @@ from telegram.ext import (
     TypeHandler,
 )
 
+import alerts
 import chatbot
+import circuit_breaker
+import file_ids
+import http_client
+import image_check
+import image_search
+import metrics
+import profiler
 import settings
-from tg_builder import TGBuilder
+import singleflight
+import subscriptions
+import trace_sampling
+import webhook
+from alert_outbox import AlertOutbox
+from bulkhead import Bulkhead, BulkheadFull
+from cache import TTLCache, run_purge
+from categories import ALL_CATEGORIES, CATEGORIES, category_bit, names_from_mask, parse_category
+from circuit_breaker import CircuitOpen, breaker
+from dead_chats import DeadChats
+from debounce import Debouncer
+from image_search import google_search
+from metrics import timed
+from subscriptions import SubscriptionIndex
+from tg_builder import FLOOD_CONTROL, TGBuilder
+from update_processor import ChatOrderedUpdateProcessor
 
 
 @dataclass
@@ -71,63 +103,170 @@ dictConfig(
             }
         },
         "handlers": {
-            "wsgi": {
+            "console": {
                 "class": "logging.StreamHandler",
                 "stream": "ext://sys.stdout",
                 "formatter": "default",
             }
         },
-        "root": {"level": "INFO", "handlers": ["wsgi"]},
+        "root": {"level": "INFO", "handlers": ["console"]},
     }
 )
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLER = trace_sampling.AdaptiveSampler(settings.SENTRY_TRACES_PER_MINUTE)
+
+# Sentry setup, tracing costs milliseconds per request even without a DSN
+if settings.SENTRY_DSN:
+    sentry_sdk.init(
+        dsn=settings.SENTRY_DSN,
+        integrations=[StarletteIntegration()],
+        # Routes and handlers are traced at a rate that keeps each one near
+        # SENTRY_TRACES_PER_MINUTE instead of capturing all traffic
+        traces_sampler=TRACE_SAMPLER,
+    )
+
+
+async def post_init(application: Application) -> None:
+    global alert_worker, reconcile_worker, replay_worker, loop_lag_worker, quota_flush_worker, cache_purge_worker
+    alert_worker = asyncio.create_task(ALERT_OUTBOX.run(application.bot))
+    if settings.SUBSCRIPTION_RECONCILE_INTERVAL:
+        reconcile_worker = asyncio.create_task(
+            subscriptions.run_reconciliation(SUBSCRIPTIONS, settings.SUBSCRIPTION_RECONCILE_INTERVAL)
+        )
+    replay_worker = asyncio.create_task(
+        subscriptions.run_replay(SUBSCRIPTIONS, settings.TARJOUSHAUKKA_REPLAY_INTERVAL)
+    )
+    quota_flush_worker = asyncio.create_task(
+        image_search.QUOTA.run_flush(settings.GOOGLE_SEARCH_QUOTA_FLUSH_INTERVAL)
+    )
+    loop_lag_worker = asyncio.create_task(metrics.monitor_event_loop_lag(settings.EVENT_LOOP_LAG_INTERVAL))
+    cache_purge_worker = asyncio.create_task(run_purge(expiring_caches(), settings.CACHE_PURGE_INTERVAL))
+    if settings.BLOCKING_CALL_THRESHOLD:
+        BLOCKING_CALLS.start(settings.BLOCKING_CALL_THRESHOLD)
+
+    if settings.PHOTO_UPLOAD_CHAT_ID:
+        try:
+            await file_ids.upload_photos(
+                PHOTO_FILE_IDS,
+                application.bot,
+                settings.PHOTO_UPLOAD_CHAT_ID,
+                error_images + not_found_images,
+            )
+        except TelegramError as e:
+            # The photos are uploaded when first sent instead
+            logger.warning(f"Could not upload photos to {settings.PHOTO_UPLOAD_CHAT_ID}: {str(e)}")
+
+
+async def stop_alert_worker():
+    """Lets alerts being delivered finish, unsent ones stay in the outbox."""
+    if alert_worker is None:
+        return
+    ALERT_OUTBOX.stop()
+    try:
+        await asyncio.wait_for(alert_worker, timeout=settings.SHUTDOWN_TIMEOUT)
+    except TimeoutError:
+        logger.warning("Alert worker didn't finish in time")
 
-# Sentry setup
-sentry_sdk.init(
-    dsn=settings.SENTRY_DSN,
-    integrations=[FlaskIntegration()],
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    # We recommend adjusting this value in production.
-    traces_sample_rate=1.0,
-)
 
-bot = TGBuilder().token(settings.TELEGRAM_TOKEN).build()
+async def post_shutdown(application: Application) -> None:
+    for worker in (reconcile_worker, replay_worker, loop_lag_worker, quota_flush_worker, cache_purge_worker):
+        if worker is not None:
+            worker.cancel()
+    await image_search.QUOTA.flush()
+    BLOCKING_CALLS.stop()
+    await http_client.close_client()
+
+
+UPDATE_PROCESSOR = ChatOrderedUpdateProcessor(settings.MAX_CONCURRENT_UPDATES, settings.MAX_PENDING_UPDATES)
+
+# Started and stopped by the ASGI server's lifespan, see lifespan()
+bot = TGBuilder().token(settings.TELEGRAM_TOKEN).concurrent_updates(UPDATE_PROCESSOR).build()
+
+IMAGES_DIR = pathlib.Path(__file__).parent / "images"
 
 error_images = [
-    "https://github.com/klemmari1/tg_vava_bot/raw/master/images/error.png",
+    IMAGES_DIR / "error.png",
 ]
 
 not_found_images = [
-    "https://github.com/klemmari1/tg_vava_bot/raw/master/images/not_found.png",
+    IMAGES_DIR / "not_found.png",
 ]
 
 not_found_captions = [
     "Your query did not match any images.",
 ]
 
-CATEGORIES = {
-    1: "Tekniikka ja elektroniikka",
-    2: "Työkalut ja rakennustarvikkeet",
-    3: "Koti ja sisustus",
-    4: "Vaatteet",
-    5: "Harrastusvälineet ja tarvikkeet",
-    6: "Autot ja ajoneuvot",
-    7: "Ruoka ja juoma",
-    8: "Kirjat ja lehdet",
-    9: "Pelit ja peliaiheiset tuotteet",
-    10: "Tietokoneen komponentit",
-    11: "Muut",
-}
-
 OPENAI_CONVERSATION_HISTORY = {}
 
-SELECTED_CATEGORIES = {}
+INLINE_DEBOUNCER = Debouncer(settings.INLINE_QUERY_QUIET_PERIOD)
+
+PHOTO_FILE_IDS = file_ids.FileIdCache(settings.FILE_ID_CACHE_SIZE)
+
+DEAD_CHATS = DeadChats()
+
+SUBSCRIPTIONS = SubscriptionIndex()
+
+ALERT_OUTBOX = AlertOutbox(DEAD_CHATS, SUBSCRIPTIONS)
+
+alert_worker = None
+
+reconcile_worker = None
+
+replay_worker = None
+
+loop_lag_worker = None
+
+quota_flush_worker = None
+
+cache_purge_worker = None
+
+# Without HOOK_SECRET the webhook has to be registered at startup to share the secret
+WEBHOOK_SECRET = settings.TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+RECENT_UPDATES = webhook.RecentUpdates(settings.WEBHOOK_RECENT_UPDATES)
+
+# Category bitmasks keyed by (user ID, message ID), until "Tilaa" is pressed
+SELECTED_CATEGORIES = TTLCache(max_bytes=1024 * 1024, default_ttl=settings.CATEGORY_SELECTION_TTL)
+
+BULKHEADS = {name: Bulkhead(**limits) for name, limits in settings.BULKHEADS.items()}
+
+BUSY_REPLY = "Busy, try again in a moment"
+
+UPDATE_PROFILER = profiler.UpdateProfiler(settings.UPDATE_PROFILE_INTERVAL)
+
+BLOCKING_CALLS = profiler.BlockingCallDetector(settings.BLOCKING_CALL_REPORTS)
+
+# Only one sampling profile at a time, overlapping ones would skew each other
+PROFILE_LOCK = asyncio.Lock()
+
+PUPPU_BREAKER = breaker("puppu")
+
+INSPIS_BREAKER = breaker("inspis")
+
+
+def limited(bulkhead_name: str):
+    """Replies busy instead of running the command when its bulkhead is full."""
+    bulkhead = BULKHEADS[bulkhead_name]
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            try:
+                async with bulkhead.slot():
+                    await handler(update, context)
+            except BulkheadFull as e:
+                logger.info(f"Shed {handler.__name__}: {str(e)}")
+                await update.message.reply_text(BUSY_REPLY)
+
+        return wrapper
+
+    return decorator
 
 
 def reset_conversation_history(chat_ids: list = []):
-    app.logger.info(f"Resetting conversation history of chat IDs: {chat_ids}")
+    logger.info(f"Resetting conversation history of chat IDs: {chat_ids}")
     if not chat_ids:
         chat_ids = settings.OPENAI_CHAT_IDS
 
@@ -139,7 +278,7 @@ reset_conversation_history()
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    app.logger.error("Exception while handling an update:", exc_info=context.error)
+    logger.error("Exception while handling an update:", exc_info=context.error)
     sentry_sdk.capture_exception(context.error)
 
 
@@ -157,7 +296,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 #                 updates = response_json.get("result", None)
 #
 #                 for update in updates:
-#                     app.logger.info("Incoming request:" + str(update))
+#                     logger.info("Incoming request:" + str(update))
 #                     if "inline_query" in update:
 #                         inline_query = update["inline_query"]
 #                         handle_inline_query(inline_query)
@@ -171,70 +310,35 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 #                 time.sleep(5)
 #
 
-# @app.route("/" + settings.TELEGRAM_HOOK, methods=["POST"])
-# def webhook_handler():
-#     if request.method == "POST":
-#         message = request.get_json(force=True)
-#         app.logger.info("Incoming request:" + str(message))
-#         if "inline_query" in message:
-#             inline_query = message["inline_query"]
-#             handle_inline_query(inline_query)
-#         else:
-#             msg = message.get("message", message.get("edited_message", None))
-#             handle_message(msg)
-#     return "ok"
-
-
-# @app.route("/set_webhook", methods=["GET"])
-# def set_webhook():
-#     app.logger.info("Host URL: " + request.host_url)
-#     s = bot.setWebhook(request.host_url + settings.TELEGRAM_HOOK)
-#     if s:
-#         return "webhook setup ok"
-#     else:
-#         return "webhook setup failed"
-
-
-# @app.route("/delete_webhook", methods=["GET"])
-# def delete_webhook():
-#     response = bot.makeRequest("deleteWebhook")
-#     if response:
-#         return "webhook delete ok"
-#     else:
-#         return "webhook delete failed"
-
-
-async def send_message_to_chat(chat_id: int, text: str) -> None:
-    temp_bot = TGBuilder().token(settings.TELEGRAM_TOKEN).build()
-
-    await temp_bot.updater.bot.send_message(
-        chat_id=chat_id,
-        text=text,
-        disable_web_page_preview=True,
-    )
-
-
 def decode_auth_token(auth_token):
     try:
         jwt.decode(auth_token, settings.EXTERNAL_ENDPOINT_KEY, algorithms=["HS256"])
     except Exception as e:
-        app.logger.exception(f"Exception while decoding auth token: {str(e)}")
+        logger.exception(f"Exception while decoding auth token: {str(e)}")
         return False
     return True
 
 
-@app.route("/send_alert", methods=["POST"])
-def send_alert():
+async def send_alert(request: Request):
     auth_token = request.headers.get("Authorization")
     auth_successful = decode_auth_token(auth_token)
     if not auth_successful:
-        return Response("Access denied!", 401)
-
-    message = request.form.get("message")
-    chat_ids = request.form.getlist("chat_ids")
-
-    # Telegram message limit is 4096 characters
-    MAX_MESSAGE_LENGTH = 4096
+        return PlainTextResponse("Access denied!", 401)
+
+    form = await request.form()
+    message = form.get("message")
+    chat_ids = [int(chat_id) for chat_id in form.getlist("chat_ids")]
+
+    # Subscribers of the category get the alert in addition to chat_ids
+    category = form.get("category")
+    if category:
+        try:
+            category = parse_category(category)
+        except ValueError:
+            return PlainTextResponse(f"Unknown category: {category}", 400)
+        chat_ids = list(dict.fromkeys(chat_ids + SUBSCRIPTIONS.recipients(category)))
+
+    MAX_MESSAGE_LENGTH = alerts.MAX_MESSAGE_LENGTH
     ELLIPSIS = "\n\n...\n\n"
 
     # Handle message length
@@ -260,26 +364,309 @@ def send_alert():
         # Reconstruct message with ellipsis
         message = main_content + ELLIPSIS + footer
 
-    # chats = Chat.query.all()
-    # chat_ids = [chat.id for chat in chats]
-    for chat_id in chat_ids:
-        # response = bot.sendMessage(
-        #     chat_id=chat_id,
-        #     text=message,
-        #     disable_web_page_preview=True,
-        # )
-        app.logger.info("SEND ALERT:")
-        app.logger.info(chat_id)
-        app.logger.info(message)
-        asyncio.new_event_loop().run_until_complete(
-            send_message_to_chat(int(chat_id), message)
-        )
-    return "OK"
+    logger.info(f"SEND ALERT to {len(chat_ids)} chats:")
+    logger.info(message)
+    job_id = ALERT_OUTBOX.enqueue(message, chat_ids)
+    return JSONResponse({"job_id": job_id}, 202)
+
 
+PARSE_MODES = {None, "HTML", "Markdown", "MarkdownV2"}
+
+
+def parse_alert_entry(entry) -> tuple:
+    if not isinstance(entry, dict):
+        raise ValueError("Entry must be an object")
+
+    message = entry.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise ValueError("Missing message")
+
+    chat_ids = entry.get("chat_ids", [])
+    category = entry.get("category")
+    if not isinstance(chat_ids, list) or not (chat_ids or category):
+        raise ValueError("Missing chat_ids or category")
+    chat_ids = [int(chat_id) for chat_id in chat_ids]
+    if category:
+        chat_ids = list(dict.fromkeys(chat_ids + SUBSCRIPTIONS.recipients(parse_category(category))))
+
+    parse_mode = entry.get("parse_mode")
+    if parse_mode not in PARSE_MODES:
+        raise ValueError(f"Unknown parse_mode: {parse_mode}")
+    # Splitting could cut through markup, so formatted alerts are sent whole
+    if parse_mode and alerts.utf16_length(message) > alerts.MAX_MESSAGE_LENGTH:
+        raise ValueError(f"Formatted message is longer than {alerts.MAX_MESSAGE_LENGTH} characters")
+
+    return message, chat_ids, parse_mode
+
+
+async def send_alerts(request: Request):
+    """Queues a JSON array of {message, chat_ids, category, parse_mode} alerts at once.
+
+    Overlong plain messages are split into several Telegram messages on
+    delivery. Formatted ones must fit in one, or the entry is rejected.
+    """
+    auth_token = request.headers.get("Authorization")
+    auth_successful = decode_auth_token(auth_token)
+    if not auth_successful:
+        return PlainTextResponse("Access denied!", 401)
+
+    try:
+        entries = await request.json()
+    except ValueError:
+        entries = None
+    if not isinstance(entries, list):
+        return PlainTextResponse("Expected a JSON array", 400)
+
+    results = []
+    valid_entries = []
+    for entry in entries:
+        try:
+            valid_entries.append(parse_alert_entry(entry))
+            results.append(None)
+        except (TypeError, ValueError) as e:
+            results.append({"error": str(e)})
+
+    job_ids = iter(ALERT_OUTBOX.enqueue_many(valid_entries))
+    results = [result or {"job_id": next(job_ids)} for result in results]
+    logger.info(f"SEND ALERTS: {len(valid_entries)}/{len(entries)} queued")
+    return JSONResponse({"results": results}, 202)
+
+
+async def send_alert_status(request: Request):
+    auth_token = request.headers.get("Authorization")
+    auth_successful = decode_auth_token(auth_token)
+    if not auth_successful:
+        return PlainTextResponse("Access denied!", 401)
+
+    status = ALERT_OUTBOX.job_status(request.path_params["job_id"])
+    if status is None:
+        return PlainTextResponse("Not found", 404)
+    return JSONResponse(status)
+
+
+async def reconcile_subscriptions(request: Request):
+    auth_token = request.headers.get("Authorization")
+    auth_successful = decode_auth_token(auth_token)
+    if not auth_successful:
+        return PlainTextResponse("Access denied!", 401)
+
+    try:
+        drift = await subscriptions.reconcile(SUBSCRIPTIONS)
+    except Exception as e:
+        logger.exception(f"Exception while reconciling subscriptions: {str(e)}")
+        return PlainTextResponse("Reconciliation failed", 502)
+    return JSONResponse(drift)
+
+
+async def telegram_webhook(request: Request):
+    """Hands updates Telegram pushes to the bot and answers before they're handled."""
+    if not webhook.is_valid_secret(request.headers.get(webhook.SECRET_HEADER), WEBHOOK_SECRET):
+        return PlainTextResponse("Access denied!", 401)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return PlainTextResponse("Expected an update", 400)
+
+    # Telegram redelivers the update later
+    if not bot.running:
+        return PlainTextResponse("Bot is not running", 503)
+
+    if not RECENT_UPDATES.seen(data["update_id"]):
+        await bot.update_queue.put(Update.de_json(data, bot.bot))
+    return PlainTextResponse("ok")
+
+
+async def admin_profile(request: Request):
+    """Samples stacks for ?seconds=N and returns them collapsed for a flame graph.
+
+    Samples the event loop thread, or every thread with ?threads=all.
+    """
+    auth_token = request.headers.get("Authorization")
+    auth_successful = decode_auth_token(auth_token)
+    if not auth_successful:
+        return PlainTextResponse("Access denied!", 401)
+
+    try:
+        seconds = float(request.query_params.get("seconds", 10))
+    except ValueError:
+        return PlainTextResponse("seconds must be a number", 400)
+    if not 0 < seconds <= settings.PROFILE_MAX_SECONDS:
+        return PlainTextResponse(f"seconds must be between 0 and {settings.PROFILE_MAX_SECONDS}", 400)
+    if PROFILE_LOCK.locked():
+        return PlainTextResponse("A profile is already running", 409)
+
+    thread_ids = None if request.query_params.get("threads") == "all" else {threading.get_ident()}
+    async with PROFILE_LOCK:
+        stacks = await asyncio.to_thread(profiler.sample_stacks, thread_ids, seconds, settings.PROFILE_INTERVAL)
+    return PlainTextResponse(profiler.format_collapsed(stacks))
+
+
+async def admin_profile_updates(request: Request):
+    """POST ?handler=cmd_img&count=N profiles the handler's next N updates, GET ?handler= returns the results."""
+    auth_token = request.headers.get("Authorization")
+    auth_successful = decode_auth_token(auth_token)
+    if not auth_successful:
+        return PlainTextResponse("Access denied!", 401)
+
+    handler_name = request.query_params.get("handler")
+    if handler_name not in PROFILED_HANDLERS:
+        return PlainTextResponse(f"handler must be one of {', '.join(sorted(PROFILED_HANDLERS))}", 400)
+
+    if request.method == "POST":
+        try:
+            count = int(request.query_params.get("count", 1))
+        except ValueError:
+            return PlainTextResponse("count must be an integer", 400)
+        if not 0 < count <= settings.UPDATE_PROFILE_MAX_COUNT:
+            return PlainTextResponse(f"count must be between 1 and {settings.UPDATE_PROFILE_MAX_COUNT}", 400)
+        UPDATE_PROFILER.arm(handler_name, count)
+        return JSONResponse({"handler": handler_name, "remaining": count}, 202)
+
+    results = UPDATE_PROFILER.results(handler_name)
+    if results is None:
+        return PlainTextResponse("Not profiled", 404)
+    return JSONResponse(results)
+
+
+async def admin_blocking_calls(request: Request):
+    """POST ?threshold=seconds starts reporting blocking calls, 0 stops. GET returns the reports."""
+    auth_token = request.headers.get("Authorization")
+    auth_successful = decode_auth_token(auth_token)
+    if not auth_successful:
+        return PlainTextResponse("Access denied!", 401)
+
+    if request.method == "POST":
+        try:
+            threshold = float(request.query_params.get("threshold", 0.1))
+        except ValueError:
+            return PlainTextResponse("threshold must be a number", 400)
+        if 0 < threshold < settings.BLOCKING_CALL_MIN_THRESHOLD:
+            return PlainTextResponse(
+                f"threshold must be 0 or at least {settings.BLOCKING_CALL_MIN_THRESHOLD}", 400
+            )
+        if threshold > 0:
+            BLOCKING_CALLS.start(threshold)
+        else:
+            BLOCKING_CALLS.stop()
+    return JSONResponse(BLOCKING_CALLS.stats())
 
-@app.route("/")
-def index():
-    return "Hello World!"
+
+async def index(request: Request):
+    return PlainTextResponse("Hello World!")
+
+
+async def health(request: Request):
+    """Reports the state and recent latency of each outbound dependency's circuit breaker."""
+    breakers = circuit_breaker.stats()
+    status = "ok" if all(state["state"] == circuit_breaker.CLOSED for state in breakers.values()) else "degraded"
+    # The bot itself is up even when a dependency is down, so always 200
+    return JSONResponse({"status": status, "bot_running": bot.running, "dependencies": breakers})
+
+
+def expiring_caches() -> list:
+    return [
+        SELECTED_CATEGORIES,
+        image_search.SEARCH_CACHE,
+        image_check.URL_RESULTS,
+        image_check.HOST_FAILURES,
+    ]
+
+
+def cache_lookups() -> dict:
+    return {
+        "search": image_search.SEARCH_CACHE,
+        "image_check": image_check.URL_RESULTS,
+        "file_ids": PHOTO_FILE_IDS,
+        "image_index": image_search.INDEX,
+    }
+
+
+metrics.Callback(
+    "bot_cache_hits_total",
+    "Cache lookups that found an entry",
+    lambda: {(name,): cache.hits for name, cache in cache_lookups().items()},
+    kind="counter",
+    labelnames=("cache",),
+)
+
+metrics.Callback(
+    "bot_cache_misses_total",
+    "Cache lookups that found nothing",
+    lambda: {(name,): cache.misses for name, cache in cache_lookups().items()},
+    kind="counter",
+    labelnames=("cache",),
+)
+
+metrics.Callback(
+    "bot_cache_hit_ratio",
+    "Share of cache lookups that found an entry since startup",
+    lambda: {
+        (name,): cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0.0
+        for name, cache in cache_lookups().items()
+    },
+    labelnames=("cache",),
+)
+
+metrics.Callback(
+    "bot_search_quota_skipped_total",
+    "Searches answered as over quota without asking Google",
+    lambda: image_search.QUOTA.skipped,
+    kind="counter",
+)
+
+metrics.Callback("bot_updates_running", "Updates being handled", lambda: UPDATE_PROCESSOR.running)
+
+metrics.Callback(
+    "bot_bulkhead_queued",
+    "Handlers waiting for a slot in their bulkhead",
+    lambda: {(name,): bulkhead.queued for name, bulkhead in BULKHEADS.items()},
+    labelnames=("bulkhead",),
+)
+
+metrics.Callback(
+    "bot_bulkhead_shed_total",
+    "Handlers turned away by their bulkhead",
+    lambda: {(name,): bulkhead.shed + bulkhead.expired for name, bulkhead in BULKHEADS.items()},
+    kind="counter",
+    labelnames=("bulkhead",),
+)
+
+
+metrics.Callback(
+    "bot_event_loop_blocked_total",
+    "Times code blocked the event loop longer than BLOCKING_CALL_THRESHOLD",
+    lambda: BLOCKING_CALLS.detected,
+    kind="counter",
+)
+
+
+async def metrics_endpoint(request: Request):
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+async def stats(request: Request):
+    return JSONResponse(
+        {
+            "search_cache": image_search.SEARCH_CACHE.stats(),
+            "single_flight": singleflight.stats(),
+            "search_quota": image_search.QUOTA.stats(),
+            "image_index": image_search.INDEX.stats(),
+            "inline_debounce": INLINE_DEBOUNCER.stats(),
+            "image_check": image_check.stats(),
+            "file_ids": PHOTO_FILE_IDS.stats(),
+            "dead_chats": DEAD_CHATS.stats(),
+            "subscriptions": SUBSCRIPTIONS.stats(),
+            "flood_control": FLOOD_CONTROL.stats(),
+            "webhook": RECENT_UPDATES.stats(),
+            "updates": UPDATE_PROCESSOR.stats(),
+            "circuit_breakers": circuit_breaker.stats(),
+            "trace_sample_rates": TRACE_SAMPLER.stats(),
+            "bulkheads": {name: bulkhead.stats() for name, bulkhead in BULKHEADS.items()},
+        }
+    )
 
 
 # def handle_message(msg):
@@ -305,25 +692,58 @@ def index():
 #             cmdname = cmdname.split("@")[0]
 #         if cmdname in commands:
 #             chat_id = str(msg["chat"]["id"])
-#             app.logger.info("command: " + str(cmdname))
-#             app.logger.info("args: " + str(args))
-#             app.logger.info("chat id: " + chat_id)
+#             logger.info("command: " + str(cmdname))
+#             logger.info("args: " + str(args))
+#             logger.info("chat id: " + chat_id)
 #             commands[cmdname](args, chat_id)
 
 
 async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.inline_query.query
-    app.logger.info(f"Handling inline query: {query}")
+    offset = update.inline_query.offset
+    logger.info(f"Handling inline query: {query}, offset: {offset}")
     if not query:  # empty query should not be handled
         return
 
+    start = int(offset) if offset.isdigit() else 1
+    # The offset comes from the client, Custom Search rejects starts outside its range
+    if not 1 <= start <= image_search.MAX_START:
+        logger.info(f"Ignored inline query with offset {offset}")
+        return
+
+    # A new query is sent on every keystroke, only search the one the user
+    # stopped at. Later pages are explicit requests and aren't debounced.
+    user_id = update.inline_query.from_user.id
+    if not offset:
+        await INLINE_DEBOUNCER.wait(user_id)
+
+    # Telegram gives up on the query soon, an answer after that is wasted
+    try:
+        async with BULKHEADS["inline"].slot():
+            await answer_inline_query(update, context, start)
+    except BulkheadFull as e:
+        logger.info(f"Dropped inline query: {str(e)}")
+
+
+async def answer_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE, start: int):
+    query = update.inline_query.query
+    offset = update.inline_query.offset
+    user_id = update.inline_query.from_user.id
+
     results = []
-    items = google_search(query)
+    next_offset = ""
+    # Don't let Telegram hold on to answers for failed searches
+    cache_time = 0
+    items = await google_search(query, start=start)
+    # Results of another query stand in for Google, so they aren't cached or paged
+    indexed = isinstance(items, image_search.IndexedItems)
     if isinstance(items, list):
+        if not indexed:
+            cache_time = settings.INLINE_CACHE_TIME
         # response = bot.sendInlineResponse(
         #     inline_query_id=inline_query_id, items=items
         # )
-        for idx, item in enumerate(items):
+        for idx, item in enumerate(items, start=start):
             photo_url = item["link"]
             thumb_url = item["image"]["thumbnailLink"]
             results.append(
@@ -333,9 +753,29 @@ async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE
                     thumbnail_url=thumb_url,
                 )
             )
-    await update.inline_query.answer(results)
+
+        next_start = start + image_search.PAGE_SIZE
+        if not indexed and len(items) == image_search.PAGE_SIZE and next_start <= image_search.MAX_START:
+            next_offset = str(next_start)
+            # Only users who have already scrolled past the first page are
+            # likely to keep going, so don't spend quota prefetching for others
+            if offset:
+                context.application.create_task(
+                    google_search(query, start=next_start), update=update
+                )
+
+    if not offset and not INLINE_DEBOUNCER.is_latest(user_id):
+        return
+
+    await update.inline_query.answer(
+        results,
+        cache_time=cache_time,
+        is_personal=False,
+        next_offset=next_offset,
+    )
 
 
+@limited("img")
 async def cmd_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(text="No query provided")
@@ -344,23 +784,34 @@ async def cmd_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = " ".join(context.args)
 
     # Get results with a query
-    items = google_search(query)
+    items = await google_search(query)
     if items == -1:
         # Send image about daily limit reached
         await daily_limit(update, context)
+        return
     elif items == -2:
         await update.message.reply_text("Exception occurred")
-    elif not items:
+        return
+
+    # Send the best ranked image that Telegram will accept
+    url = None
+    if isinstance(items, list):
+        # Photos sent before go by file_id, so their host doesn't have to be up
+        url = await image_check.first_valid_photo_url([item["link"] for item in items], known=PHOTO_FILE_IDS)
+    if url is None:
         # Send image about image not found
         await not_found(update, context)
-    # Send image
-    if isinstance(items, list) and len(items) > 0:
-        url = items[0]["link"]
-        await update.message.reply_photo(url)
         return
-    await not_found(update, context)
+
+    try:
+        await file_ids.reply_photo(PHOTO_FILE_IDS, update.message, url)
+    except BadRequest as e:
+        logger.info(f"Telegram could not send {url}: {str(e)}")
+        image_check.mark_bad(url)
+        await not_found(update, context)
 
 
+@limited("scrape")
 async def cmd_puppu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ""
     if context.args:
@@ -368,15 +819,23 @@ async def cmd_puppu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     query = urllib.parse.quote_plus(query, safe="", encoding="utf-8", errors=None)
     url = "http://puppulausegeneraattori.fi/?avainsana=" + query
-    response = urllib.request.urlopen(url, timeout=settings.REQUEST_TIMEOUT).read()
-    soup = BeautifulSoup(response, "html.parser")
+    try:
+        with PUPPU_BREAKER.guard():
+            response = await http_client.get_client().get(url)
+            response.raise_for_status()
+    except (CircuitOpen, httpx.HTTPError) as e:
+        logger.warning(f"Puppulausegeneraattori failed: {repr(e)}")
+        await unavailable(update, context)
+        return
+    soup = BeautifulSoup(response.content, "html.parser")
     text = soup.find("p", {"class": "lause"})
     text = text.contents[0]
-    app.logger.info(f"Puppulause: {text}")
+    logger.info(f"Puppulause: {text}")
     # bot.sendMessage(chat_id=chat_id, text=text)
     await update.message.reply_text(text.text)
 
 
+@limited("scrape")
 async def cmd_inspis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     url = "https://inspirobot.me/api?generate=true"
     headers = {
@@ -384,7 +843,14 @@ async def cmd_inspis(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "AppleWebKit/537.36 (KHTML, like Gecko)"
         "Chrome/50.0.2661.102 Safari/537.36"
     }
-    response = requests.get(url, headers=headers, timeout=settings.REQUEST_TIMEOUT)
+    try:
+        with INSPIS_BREAKER.guard():
+            response = await http_client.get_client().get(url, headers=headers)
+            response.raise_for_status()
+    except (CircuitOpen, httpx.HTTPError) as e:
+        logger.warning(f"Inspirobot failed: {repr(e)}")
+        await unavailable(update, context)
+        return
     url = response.content.decode("utf-8")
     # bot.sendPhoto(chat_id=chat_id, photo=url)
     await update.message.reply_photo(url)
@@ -405,10 +871,13 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # )
 
 
-def get_category_keyboard():
+@functools.lru_cache(maxsize=ALL_CATEGORIES + 1)
+def category_keyboard(selected: int = 0) -> InlineKeyboardMarkup:
+    """Category selection keyboard with the categories in the selected bitmask checked."""
     keyboard = []
     for idx, category in CATEGORIES.items():
-        keyboard.append([InlineKeyboardButton(category, callback_data=str(idx))])
+        text = f"{category}" + (" ✅" if selected & category_bit(idx) else "")
+        keyboard.append([InlineKeyboardButton(text, callback_data=str(idx))])
     keyboard.append([InlineKeyboardButton("Tilaa", callback_data="tilaa")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -416,34 +885,29 @@ def get_category_keyboard():
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Parses the CallbackQuery and updates the message text."""
     query = update.callback_query
-    app.logger.info(f"Handling button callback: {query}")
+    logger.info(f"Handling button callback: {query}")
     await query.answer()
 
     user_id = query.from_user.id
     chat_id = query.message.chat.id
+    # Users in a group each make their own selection on the same keyboard
+    selection_key = (user_id, query.message.message_id)
 
     # Handle submission
     if query.data == "tilaa":
+        # Alerts can reach the chat again if it was pruned earlier
+        DEAD_CHATS.revive(chat_id)
+        selected = SELECTED_CATEGORIES.pop(selection_key, 0)
+        selected_categories = names_from_mask(selected)
         selected_categories_text = ""
-        selected_categories = []
-        if user_id in SELECTED_CATEGORIES and SELECTED_CATEGORIES[user_id]:
-            for idx in SELECTED_CATEGORIES[user_id]:
-                category = CATEGORIES[int(idx)]
-                selected_categories_text += f"*\- {category}*\n"
-                selected_categories.append(category)
-
-            if SELECTED_CATEGORIES[user_id]:
-                del SELECTED_CATEGORIES[user_id]
-
-        data = {
-            "chat-id": chat_id,
-            "categories": selected_categories,
-            "sub-type": "subscribe",
-        }
-        requests.post(
-            f"{settings.TARJOUSHAUKKA_URL}/chat",
-            data=data,
-        )
+        for category in selected_categories:
+            selected_categories_text += f"*\- {category}*\n"
+
+        # No selection subscribes to every category
+        mask = selected or ALL_CATEGORIES
+        SUBSCRIPTIONS.subscribe(chat_id, mask)
+        # Confirmed right away, the change is replayed later if Tarjoushaukka is down
+        context.application.create_task(subscriptions.push_subscription(SUBSCRIPTIONS, chat_id))
         # chat = chats.Chat(
         #     str(chat_id),
         # )
@@ -461,30 +925,20 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
         return
 
-    # Track user selections
-    if user_id not in SELECTED_CATEGORIES:
-        SELECTED_CATEGORIES[user_id] = []
-
-    if query.data not in SELECTED_CATEGORIES[user_id]:
-        SELECTED_CATEGORIES[user_id].append(query.data)
-    else:
-        SELECTED_CATEGORIES[user_id].remove(query.data)
+    # Toggling doesn't await between reading and writing the selection, so
+    # concurrent toggles can't lose each other's changes
+    selected = SELECTED_CATEGORIES.get(selection_key, 0) ^ category_bit(int(query.data))
+    SELECTED_CATEGORIES.set(selection_key, selected)
 
     # Update the keyboard to reflect current selections
-    markup = await get_updated_keyboard(SELECTED_CATEGORIES[user_id])
-    await query.edit_message_reply_markup(
-        reply_markup=markup,
-    )
-
-
-async def get_updated_keyboard(selected):
-    """Updates the keyboard based on the selected categories."""
-    keyboard = []
-    for idx, category in CATEGORIES.items():
-        text = f"{category}" + (" ✅" if str(idx) in selected else "")
-        keyboard.append([InlineKeyboardButton(text, callback_data=str(idx))])
-    keyboard.append([InlineKeyboardButton("Tilaa", callback_data="tilaa")])
-    return InlineKeyboardMarkup(keyboard)
+    try:
+        await query.edit_message_reply_markup(
+            reply_markup=category_keyboard(selected),
+        )
+    except BadRequest as e:
+        # Another user's selection left the same keyboard on the message
+        if "not modified" not in e.message:
+            raise
 
 
 async def cmd_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -508,69 +962,28 @@ async def cmd_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Paina lopuksi *Tilaa*\.\n\n"
         "Paina vain *Tilaa* jos haluat tilata kaikki kategoriat\.\n",
         parse_mode="MarkdownV2",
-        reply_markup=get_category_keyboard(),
+        reply_markup=category_keyboard(),
     )
 
 
 async def cmd_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = str(update.message.chat_id)
-    data = {
-        "chat-id": chat_id,
-        "sub-type": "unsubscribe",
-    }
-    response = requests.post(
-        f"{settings.TARJOUSHAUKKA_URL}/chat",
-        data=data,
-    )
-    # chat = Chat.query.get(chat_id)
+    chat_id = update.message.chat_id
+    SUBSCRIPTIONS.unsubscribe(chat_id)
+    # Confirmed right away, the change is replayed later if Tarjoushaukka is down
+    context.application.create_task(subscriptions.push_subscription(SUBSCRIPTIONS, chat_id))
 
-    # bot.sendMessage(
-    #     chat_id=chat_id,
-    #     text=text,
-    # )
     await update.message.reply_text(
-        f'*{response.json()["status"]}*',
+        "*Tarjousviestien tilaus peruttu*",
         parse_mode="MarkdownV2",
     )
 
 
-def google_search(search_terms):
-    # Use Google Custom Search API to find an image
-    try:
-        searchType = "image"
-        gl = "fi"
-        url = (
-            "https://www.googleapis.com/customsearch/v1?q="
-            + search_terms
-            + "&key="
-            + settings.GOOGLE_SEARCH_KEY
-            + "&cx="
-            + settings.GOOGLE_SEARCH_CX
-            + "&searchType="
-            + searchType
-            + "&gl="
-            + gl
-        )
-        contents = requests.get(url, timeout=settings.REQUEST_TIMEOUT).text
-        json_response = json.loads(contents)
-        if "items" in json_response:
-            return json_response["items"]
-        elif "error" in json_response:
-            if "message" in json_response["error"]:
-                if "billing" in json_response["error"]["message"]:
-                    return -1
-        return None
-    except Exception as e:
-        app.logger.exception("Exception while processing google search: " + str(e))
-        return -2
-
-
 async def test_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ""
     if context.args:
         query = " ".join(context.args)
 
-    app.logger.info(f"Image query: {query}")
+    logger.info(f"Image query: {query}")
 
     if query == "1":
         await daily_limit(update, context)
@@ -578,7 +991,9 @@ async def test_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def daily_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_photo(
+    await file_ids.reply_photo(
+        PHOTO_FILE_IDS,
+        update.message,
         random.choice(error_images),
         "You've reached the daily search limit of Google API :(",
     )
@@ -591,8 +1006,19 @@ async def daily_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # )
 
 
+async def unavailable(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await file_ids.reply_photo(
+        PHOTO_FILE_IDS,
+        update.message,
+        random.choice(error_images),
+        "The service is not responding, try again later",
+    )
+
+
 async def not_found(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_photo(random.choice(not_found_images))
+    await file_ids.reply_photo(
+        PHOTO_FILE_IDS, update.message, random.choice(not_found_images)
+    )
     # return bot.sendPhoto(
     #     chat_id=chat_id,
     #     photo=random.choice(not_found_images),
@@ -600,6 +1026,7 @@ async def not_found(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # )
 
 
+@limited("ask")
 async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.message.chat_id)
 
@@ -619,10 +1046,12 @@ async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("GPT-4 not enabled in this chat")
         return
 
-    gpt_response = chatbot.query(
+    # The OpenAI client blocks, other chats are handled meanwhile
+    gpt_response = await asyncio.to_thread(
+        chatbot.query,
         query,
         OPENAI_CONVERSATION_HISTORY[chat_id],
-        app.logger,
+        logger,
         max_turns=5,
     )
 
@@ -655,36 +1084,115 @@ async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def logging_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    app.logger.info(f"Received message: {str(update)}")
+    logger.info(f"Received message: {str(update)}")
+
+
+PROFILED_HANDLERS = set()
+
+
+def instrumented(handler):
+    """Wraps an update handler with metrics, Sentry tracing and on-demand profiling."""
+    PROFILED_HANDLERS.add(handler.__name__)
+    profiled = timed(UPDATE_PROFILER.profiled(handler))
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with sentry_sdk.start_transaction(op="telegram.handler", name=handler.__name__, source="component"):
+            return await profiled(update, context)
+
+    return wrapper
 
 
 bot.add_handler(TypeHandler(Update, logging_handler), group=-1)
 
-bot.add_handler(CommandHandler("subscribe", cmd_subscribe))
-bot.add_handler(CommandHandler("unsubscribe", cmd_unsubscribe))
-bot.add_handler(CommandHandler("img", cmd_img))
-bot.add_handler(CommandHandler("puppu", cmd_puppu))
-bot.add_handler(CommandHandler("inspis", cmd_inspis))
-bot.add_handler(CommandHandler("ask", cmd_ask))
-bot.add_handler(CommandHandler("reset", cmd_reset))
-bot.add_handler(CommandHandler("help", cmd_help))
-bot.add_handler(CommandHandler("vtest", test_img))
+bot.add_handler(CommandHandler("subscribe", instrumented(cmd_subscribe)))
+bot.add_handler(CommandHandler("unsubscribe", instrumented(cmd_unsubscribe)))
+bot.add_handler(CommandHandler("img", instrumented(cmd_img)))
+bot.add_handler(CommandHandler("puppu", instrumented(cmd_puppu)))
+bot.add_handler(CommandHandler("inspis", instrumented(cmd_inspis)))
+bot.add_handler(CommandHandler("ask", instrumented(cmd_ask)))
+bot.add_handler(CommandHandler("reset", instrumented(cmd_reset)))
+bot.add_handler(CommandHandler("help", instrumented(cmd_help)))
+bot.add_handler(CommandHandler("vtest", instrumented(test_img)))
 
-bot.add_handler(InlineQueryHandler(handle_inline_query))
+# Non-blocking so debounced queries can wait without holding up other updates
+bot.add_handler(InlineQueryHandler(instrumented(handle_inline_query), block=False))
 
-bot.add_handler(CallbackQueryHandler(button_callback))
+bot.add_handler(CallbackQueryHandler(instrumented(button_callback)))
 
 bot.add_error_handler(error_handler)
 
-app_thread = threading.Thread(
-    target=lambda: app.run(
-        host="0.0.0.0", port=settings.PORT, debug=True, use_reloader=False
-    )
-)
-app_thread.start()
 
+def polling_error(error):
+    bot.create_task(bot.process_error(error=error, update=None))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_: Starlette):
+    """Runs the bot on the server's event loop for as long as the server is up."""
+    await bot.initialize()
+    try:
+        await post_init(bot)
+        if not settings.TELEGRAM_HOOK:
+            # Polling deletes any registered webhook
+            await bot.updater.start_polling(error_callback=polling_error)
+        elif settings.TELEGRAM_WEBHOOK_URL:
+            await bot.bot.set_webhook(
+                url=f"{settings.TELEGRAM_WEBHOOK_URL}/{settings.TELEGRAM_HOOK}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        elif not settings.TELEGRAM_WEBHOOK_SECRET:
+            logger.warning("Neither HOOK_URL nor HOOK_SECRET is set, webhook requests will be rejected")
+        await bot.start()
+        yield
+    finally:
+        if bot.updater.running:
+            try:
+                await asyncio.wait_for(bot.updater.stop(), timeout=settings.SHUTDOWN_TIMEOUT)
+            except TimeoutError:
+                logger.warning("Updater didn't stop in time")
+        # Alerts being sent still need the bot's connections
+        await stop_alert_worker()
+        if bot.running:
+            # Handles the updates that were already received
+            try:
+                await asyncio.wait_for(bot.stop(), timeout=settings.SHUTDOWN_TIMEOUT)
+            except TimeoutError:
+                logger.warning("Updates weren't handled in time")
+        await bot.shutdown()
+        await post_shutdown(bot)
+
+
+routes = [
+    Route("/", index),
+    Route("/health", health),
+    Route("/stats", stats),
+    Route("/metrics", metrics_endpoint),
+    Route("/send_alert", send_alert, methods=["POST"]),
+    Route("/send_alerts", send_alerts, methods=["POST"]),
+    Route("/send_alert/{job_id}", send_alert_status, methods=["GET"]),
+    Route("/subscriptions/reconcile", reconcile_subscriptions, methods=["POST"]),
+    Route("/admin/profile", admin_profile, methods=["POST"]),
+    Route("/admin/profile/updates", admin_profile_updates, methods=["GET", "POST"]),
+    Route("/admin/blocking_calls", admin_blocking_calls, methods=["GET", "POST"]),
+]
+
+if settings.TELEGRAM_HOOK:
+    routes.append(Route("/" + settings.TELEGRAM_HOOK, telegram_webhook, methods=["POST"]))
+
+app = Starlette(routes=routes, lifespan=lifespan)
+
+
+def main():
+    # A single process, the bot may only poll for updates from one place
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(settings.PORT),
+        timeout_graceful_shutdown=settings.SHUTDOWN_TIMEOUT,
+    )
 
-bot.run_polling()
 
-# Stop the Flask app thread when the bot stops
-app_thread.join()
+if __name__ == "__main__":
+    main()
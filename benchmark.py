@@ -0,0 +1,312 @@
+"""
+Benchmarks for the bot's hot paths against local fakes of external services.
+
+Usage: python benchmark.py [search] [send_alert] [updates]
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import jwt
+import requests
+
+import settings
+
+FAKE_LATENCY = 0.5
+CONCURRENCY = 50
+
+FAKE_SEARCH_RESPONSE = json.dumps(
+    {
+        "items": [
+            {
+                "link": f"https://example.com/{idx}.jpg",
+                "image": {"thumbnailLink": f"https://example.com/{idx}_thumb.jpg"},
+            }
+            for idx in range(10)
+        ]
+    }
+).encode()
+
+
+async def handle_fake_search(reader, writer):
+    # Minimal HTTP/1.1 server that keeps connections alive like googleapis.com
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            await asyncio.sleep(FAKE_LATENCY)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: " + str(len(FAKE_SEARCH_RESPONSE)).encode() + b"\r\n"
+                b"\r\n" + FAKE_SEARCH_RESPONSE
+            )
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def start_fake_server(handler) -> str:
+    """Serves handler on its own event loop thread so a blocked bot loop can't stall it."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(
+        asyncio.start_server(handler, "127.0.0.1", 0), loop
+    ).result()
+    port = server.sockets[0].getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+async def run_queries(search, count: int) -> float:
+    # Half /img, half inline queries; both end up in google_search
+    queries = [f"{'img' if idx % 2 else 'inline'} query {idx}" for idx in range(count)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(search(query) for query in queries))
+    elapsed = time.perf_counter() - start
+    assert all(isinstance(items, list) for items in results)
+    return elapsed
+
+
+async def blocking_google_search(search_terms):
+    # The previous implementation: synchronous requests.get inside the handler
+    response = requests.get(
+        settings.GOOGLE_SEARCH_URL,
+        params={"q": search_terms},
+        timeout=settings.REQUEST_TIMEOUT,
+    )
+    return response.json()["items"]
+
+
+async def bench_search():
+    import http_client
+    import image_search
+    from image_search import google_search
+
+    settings.GOOGLE_SEARCH_URL = start_fake_server(handle_fake_search) + "/customsearch/v1"
+    settings.SEARCH_TIMEOUT = 30
+    print(f"Fake Custom Search latency {FAKE_LATENCY}s, {CONCURRENCY} concurrent queries")
+
+    elapsed = await run_queries(blocking_google_search, CONCURRENCY)
+    print(f"  blocking requests.get: {elapsed:.2f}s, {CONCURRENCY / elapsed:.1f} queries/s")
+
+    elapsed = await run_queries(google_search, CONCURRENCY)
+    print(f"  async httpx (cold):    {elapsed:.2f}s, {CONCURRENCY / elapsed:.1f} queries/s")
+
+    image_search.SEARCH_CACHE.clear()
+    elapsed = await run_queries(google_search, CONCURRENCY)
+    print(f"  async httpx (warm):    {elapsed:.2f}s, {CONCURRENCY / elapsed:.1f} queries/s")
+
+    elapsed = await run_queries(google_search, CONCURRENCY)
+    print(f"  cached:                {elapsed:.4f}s, {CONCURRENCY / elapsed:.1f} queries/s")
+
+    await http_client.close_client()
+
+
+ALERT_REQUESTS = 2000
+ALERT_PORT = 5098
+
+
+def serve_send_alert_flask(directory: str):
+    # The previous setup: Flask's development server with debug=True
+    from flask import Flask, Response, request
+
+    os.chdir(directory)
+    import app as bot_app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    flask_app = Flask(__name__)
+
+    @flask_app.route("/send_alert", methods=["POST"])
+    def send_alert():
+        if not bot_app.decode_auth_token(request.headers.get("Authorization")):
+            return Response("Access denied!", 401)
+        chat_ids = [int(chat_id) for chat_id in request.form.getlist("chat_ids")]
+        job_id = bot_app.ALERT_OUTBOX.enqueue(request.form.get("message"), chat_ids)
+        return {"job_id": job_id}, 202
+
+    flask_app.run(port=ALERT_PORT, debug=True, use_reloader=False)
+
+
+def serve_send_alert_asgi(directory: str):
+    import uvicorn
+
+    os.chdir(directory)
+    import app as bot_app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Without the lifespan the bot isn't started, alerts are only queued
+    uvicorn.run(bot_app.app, port=ALERT_PORT, lifespan="off", log_level="warning")
+
+
+async def read_response(reader: asyncio.StreamReader) -> bool:
+    """Reads an accepted /send_alert response, returns whether the server closes the connection."""
+    status = await reader.readline()
+    assert b" 202 " in status, status
+    length, close = 0, False
+    while (line := (await reader.readline()).lower()) != b"\r\n":
+        if line.startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+        elif line.startswith(b"connection: close"):
+            close = True
+    await reader.readexactly(length)
+    return close
+
+
+async def wait_for_server(port: int):
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+
+
+async def post_alerts(port: int, count: int) -> float:
+    # Raw HTTP/1.1 so the load generator isn't what's measured on small machines
+    token = jwt.encode({}, settings.EXTERNAL_ENDPOINT_KEY, algorithm="HS256")
+    body = urllib.parse.urlencode({"message": "Benchmark alert", "chat_ids": ["1", "2", "3"]}, doseq=True)
+    request = (
+        f"POST /send_alert HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{port}\r\n"
+        f"Authorization: {token}\r\n"
+        f"Content-Type: application/x-www-form-urlencoded\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"\r\n{body}"
+    ).encode()
+    remaining = iter(range(count))
+
+    async def worker():
+        writer = None
+        for _ in remaining:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            # Flask's development server closes the connection after every response
+            if await read_response(reader):
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+
+    await wait_for_server(port)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    return time.perf_counter() - start
+
+
+async def bench_send_alert():
+    print(f"{ALERT_REQUESTS} POST /send_alert requests, {CONCURRENCY} concurrent")
+    servers = [
+        ("Flask dev server", serve_send_alert_flask),
+        ("uvicorn ASGI", serve_send_alert_asgi),
+    ]
+    for name, serve in servers:
+        with tempfile.TemporaryDirectory() as directory:
+            server = multiprocessing.Process(target=serve, args=(directory,), daemon=True)
+            server.start()
+            try:
+                elapsed = await post_alerts(ALERT_PORT, ALERT_REQUESTS)
+            finally:
+                server.terminate()
+                server.join()
+        print(f"  {name + ':':18} {elapsed:.2f}s, {ALERT_REQUESTS / elapsed:.0f} requests/s")
+
+
+UPDATE_RATE = 10
+UPDATE_COUNT = 100
+UPDATE_CHATS = 20
+
+# Command, share of updates and how long its fake handler takes
+UPDATE_MIX = [
+    ("/ask", 0.1, 1.0),
+    ("/img", 0.4, 0.05),
+    ("/puppu", 0.5, 0.15),
+]
+
+
+def make_updates(count: int) -> list:
+    from telegram import Chat, Message, Update, User
+
+    rng = random.Random(0)
+    commands = [command for command, _, _ in UPDATE_MIX]
+    weights = [share for _, share, _ in UPDATE_MIX]
+    updates = []
+    for update_id in range(count):
+        chat_id = rng.randrange(UPDATE_CHATS)
+        chat = Chat(id=chat_id, type=Chat.GROUP)
+        user = User(id=chat_id, first_name="Bench", is_bot=False)
+        text = rng.choices(commands, weights)[0] + " kissa"
+        message = Message(message_id=update_id, date=None, chat=chat, from_user=user, text=text)
+        updates.append(Update(update_id=update_id, message=message))
+    return updates
+
+
+async def feed_updates(processor, updates: list) -> list:
+    """Feeds updates at Poisson arrival times and returns each one's handling latency."""
+    durations = {command: duration for command, _, duration in UPDATE_MIX}
+    rng = random.Random(1)
+    latencies = []
+
+    async def handle(update, arrived):
+        await asyncio.sleep(durations[update.message.text.split()[0]])
+        latencies.append(time.perf_counter() - arrived)
+
+    tasks = []
+    for update in updates:
+        await asyncio.sleep(rng.expovariate(UPDATE_RATE))
+        coroutine = handle(update, time.perf_counter())
+        tasks.append(asyncio.create_task(processor.process_update(update, coroutine)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+async def bench_updates():
+    from telegram.ext import SimpleUpdateProcessor
+
+    from update_processor import ChatOrderedUpdateProcessor
+
+    print(
+        f"{UPDATE_COUNT} updates at {UPDATE_RATE}/s from {UPDATE_CHATS} chats: "
+        + ", ".join(f"{share:.0%} {command} {duration * 1000:.0f}ms" for command, share, duration in UPDATE_MIX)
+    )
+    processors = [
+        ("Sequential", SimpleUpdateProcessor(1)),
+        (
+            "Per-chat ordered",
+            ChatOrderedUpdateProcessor(settings.MAX_CONCURRENT_UPDATES, settings.MAX_PENDING_UPDATES),
+        ),
+    ]
+    updates = make_updates(UPDATE_COUNT)
+    for name, processor in processors:
+        latencies = await feed_updates(processor, updates)
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f"  {name + ':':18} p50 {quantiles[49] * 1000:.0f}ms, p99 {quantiles[98] * 1000:.0f}ms")
+
+
+BENCHMARKS = {
+    "search": bench_search,
+    "send_alert": bench_send_alert,
+    "updates": bench_updates,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        asyncio.run(BENCHMARKS[name]())
@@ -0,0 +1,67 @@
+import asyncio
+import contextlib
+
+
+class BulkheadFull(Exception):
+    pass
+
+
+class Bulkhead:
+    """Bounds how many handlers of one kind run and wait at once.
+
+    Callers over the queue limit, or still queued when the deadline passes,
+    are shed with BulkheadFull instead of piling up behind a slow dependency.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int, deadline: float):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.deadline = deadline
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.running = 0
+        self.queued = 0
+        self.max_seen_queued = 0
+        # Rejected because the queue was full
+        self.shed = 0
+        # Waited the whole deadline without getting a slot
+        self.expired = 0
+        self.passed = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Waits for a slot for the duration of the block, raises BulkheadFull if none is free in time."""
+        if self.semaphore.locked():
+            if self.queued >= self.max_queued:
+                self.shed += 1
+                raise BulkheadFull("Queue is full")
+            self.queued += 1
+            self.max_seen_queued = max(self.max_seen_queued, self.queued)
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.deadline)
+            except asyncio.TimeoutError:
+                self.expired += 1
+                raise BulkheadFull(f"No slot in {self.deadline}s") from None
+            finally:
+                self.queued -= 1
+        else:
+            await self.semaphore.acquire()
+
+        self.running += 1
+        self.passed += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "max_running": self.max_concurrent,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "max_seen_queued": self.max_seen_queued,
+            "shed": self.shed,
+            "expired": self.expired,
+            "passed": self.passed,
+        }
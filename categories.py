@@ -0,0 +1,43 @@
+CATEGORIES = {
+    1: "Tekniikka ja elektroniikka",
+    2: "Työkalut ja rakennustarvikkeet",
+    3: "Koti ja sisustus",
+    4: "Vaatteet",
+    5: "Harrastusvälineet ja tarvikkeet",
+    6: "Autot ja ajoneuvot",
+    7: "Ruoka ja juoma",
+    8: "Kirjat ja lehdet",
+    9: "Pelit ja peliaiheiset tuotteet",
+    10: "Tietokoneen komponentit",
+    11: "Muut",
+}
+
+CATEGORY_IDS = {category: idx for idx, category in CATEGORIES.items()}
+
+# Category selections are stored as bitmasks, bit idx - 1 for category idx
+ALL_CATEGORIES = (1 << len(CATEGORIES)) - 1
+
+
+def category_bit(idx: int) -> int:
+    return 1 << (idx - 1)
+
+
+def mask_from_names(names: list) -> int:
+    mask = 0
+    for name in names:
+        mask |= category_bit(CATEGORY_IDS[name])
+    return mask
+
+
+def names_from_mask(mask: int) -> list:
+    return [category for idx, category in CATEGORIES.items() if mask & category_bit(idx)]
+
+
+def parse_category(value) -> int:
+    """Returns the category ID for an ID or a category name."""
+    if isinstance(value, str) and value in CATEGORY_IDS:
+        return CATEGORY_IDS[value]
+    idx = int(value)
+    if idx not in CATEGORIES:
+        raise ValueError(f"Unknown category: {value}")
+    return idx
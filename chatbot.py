@@ -2,18 +2,31 @@
 # https://www.apache.org/licenses/LICENSE-2.0
 import json
 import re
+import time
 import traceback
 
 import openai
 import requests
+import riotwatcher
 import wikipedia
 from openai import RateLimitError, APIStatusError, APIError
 
+import metrics
 import riot_summoner_api
 import settings
+from circuit_breaker import CircuitOpen, breaker
+from singleflight import single_flight
 
 openai.api_key = settings.OPENAI_API_KEY
 
+OPENAI_BREAKER = breaker("openai")
+LOLWIKI_BREAKER = breaker("lolwiki")
+RIOTAPI_BREAKER = breaker("riotapi")
+
+OPENAI_TURNS = metrics.Histogram(
+    "bot_openai_turns", "OpenAI completions needed to answer one question", buckets=(1, 2, 3, 4, 5, 10)
+)
+
 
 class ChatBot:
     def __init__(self, system=""):
@@ -29,19 +42,33 @@ class ChatBot:
         return result
 
     def execute(self):
+        if not OPENAI_BREAKER.allow():
+            return "OpenAI is not responding, try again later"
+        started = time.monotonic()
+        ok = None
         try:
             completion = openai.ChatCompletion.create(
                 model="gpt-4", messages=self.messages
             )
+            ok = True
         except RateLimitError:
+            ok = False
             traceback.print_exc()
             return "OpenAI Rate Limit Error", 0
         except APIStatusError as e:
+            # Our own bad requests don't mean OpenAI is down
+            ok = e.status_code < 500
             print(str(e))
             return "OpenAI returned APIStatusError"
         except APIError as e:
+            ok = False
             print(str(e))
             return "OpenAI returned APIError"
+        except Exception:
+            ok = False
+            raise
+        finally:
+            OPENAI_BREAKER.record(started, ok)
         # Uncomment this to print out token usage each time, e.g.
         # {"completion_tokens": 86, "prompt_tokens": 26, "total_tokens": 112}
         # print(completion.usage)
@@ -153,9 +180,14 @@ def query(
             next_prompt = f"Observation: {observation}"
         else:
             result = re.sub("^Thought: (.*)\s*", "", result)
+            OPENAI_TURNS.observe(i)
             return result
 
+    # Ran out of turns without an answer
+    OPENAI_TURNS.observe(i)
+
 
+@single_flight("wikipedia")
 def wikipedia_query(q: str) -> str:
     results = wikipedia.search(q)
     if len(results) > 0 and all([w in results[0] for w in q.split(" ")]):
@@ -172,7 +204,16 @@ def lolwiki(q: str) -> str:
         "X-RapidAPI-Host": "league-of-legends-champions.p.rapidapi.com",
     }
 
-    response = requests.request("GET", url, headers=headers, timeout=30)
+    try:
+        with LOLWIKI_BREAKER.guard():
+            response = requests.request("GET", url, headers=headers, timeout=30)
+            # Server errors count against the breaker, a bad query doesn't
+            if response.status_code >= 500:
+                response.raise_for_status()
+    except CircuitOpen:
+        return "LoLWiki is not responding"
+    except requests.HTTPError:
+        return f"LoLWiki returned HTTP {response.status_code}"
 
     assert response.status_code == 200
 
@@ -191,7 +232,13 @@ def riotapi(q: str) -> str:
     q_split = q.split(" ")
     summoner_name = q_split[0]
     region = q_split[1]
-    return str(riot_summoner_api.get_summoner_match_info(summoner_name, region))
+    try:
+        with RIOTAPI_BREAKER.guard():
+            return str(riot_summoner_api.get_summoner_match_info(summoner_name, region))
+    except CircuitOpen:
+        return "Riot API is not responding"
+    except riotwatcher.ApiError:
+        return "APIError when querying Riot API"
 
 
 def calculate(q: str) -> str:
@@ -0,0 +1,158 @@
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+import settings
+
+logger = logging.getLogger(__name__)
+
+BREAKERS = {}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# How many of the latest call durations are kept for the latency figures
+LATENCY_WINDOW = 50
+
+DEPENDENCY_LATENCY = metrics.Histogram(
+    "bot_dependency_seconds", "Duration of calls to outbound dependencies", ("dependency",)
+)
+
+DEPENDENCY_ERRORS = metrics.Counter(
+    "bot_dependency_errors_total", "Failed calls to outbound dependencies", ("dependency",)
+)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Fails calls to a dependency immediately while it is known to be down.
+
+    Opens after failure_threshold consecutive failures. After reset_timeout
+    seconds one probe call is let through: its success closes the breaker,
+    its failure keeps it open for another reset_timeout. Thread safe, so it
+    also guards blocking calls made from worker threads.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        BREAKERS[name] = self
+
+    def allow(self) -> bool:
+        """Returns whether a call may go through, claiming the probe if one is due.
+
+        Every allowed call must be followed by record().
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, started: float, ok):
+        """Records the outcome of an allowed call started at the monotonic time started.
+
+        ok is None when the call said nothing about the dependency's health,
+        e.g. when it was cancelled.
+        """
+        elapsed = time.monotonic() - started
+        DEPENDENCY_LATENCY.observe(elapsed, self.name)
+        if ok is False:
+            DEPENDENCY_ERRORS.inc(self.name)
+        with self._lock:
+            self.latencies.append(elapsed)
+            probe = self.probing
+            self.probing = False
+            if ok is None:
+                return
+            if ok:
+                if self.state != CLOSED:
+                    logger.info(f"Circuit {self.name} closed")
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if probe or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def guard(self):
+        """Raises CircuitOpen if the breaker is open, otherwise records how the block went.
+
+        Any exception from the block counts as a failure.
+        """
+        if not self.allow():
+            raise CircuitOpen(f"{self.name} is unavailable")
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.record(started, False)
+            raise
+        except BaseException:
+            self.record(started, None)
+            raise
+        self.record(started, True)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected,
+            "latency_ms": {
+                "avg": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                "p95": round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else None,
+                "max": round(latencies[-1] * 1000, 1) if latencies else None,
+            },
+        }
+
+
+def breaker(name: str) -> CircuitBreaker:
+    """Returns the named breaker, creating it with the default limits."""
+    if name not in BREAKERS:
+        CircuitBreaker(name, settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_RESET_TIMEOUT)
+    return BREAKERS[name]
+
+
+metrics.Callback(
+    "bot_dependency_rejected_total",
+    "Calls failed at once because the dependency's circuit was open",
+    lambda: {(name,): circuit.rejected for name, circuit in BREAKERS.items()},
+    kind="counter",
+    labelnames=("dependency",),
+)
+
+metrics.Callback(
+    "bot_dependency_up",
+    "Whether the dependency's circuit is closed",
+    lambda: {(name,): int(circuit.state == CLOSED) for name, circuit in BREAKERS.items()},
+    labelnames=("dependency",),
+)
+
+
+def stats() -> dict:
+    return {name: circuit.stats() for name, circuit in BREAKERS.items()}
@@ -0,0 +1,24 @@
+import logging
+import sqlite3
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+SQLITE_PREFIX = "sqlite:///"
+DEFAULT_PATH = "app.db"
+
+
+def database_path() -> str:
+    if settings.DATABASE_URL.startswith(SQLITE_PREFIX):
+        return settings.DATABASE_URL[len(SQLITE_PREFIX):]
+    logger.warning(f"DATABASE_URL is not an SQLite URL, using {DEFAULT_PATH}")
+    return DEFAULT_PATH
+
+
+def connect() -> sqlite3.Connection:
+    """Opens a new connection to the bot's local SQLite database."""
+    db = sqlite3.connect(database_path(), check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+import database
+
+logger = logging.getLogger(__name__)
+
+
+def is_permanent_failure(error: TelegramError) -> bool:
+    """Whether sending to the chat can never succeed, e.g. the bot was blocked or removed."""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in error.message.lower()
+
+
+class DeadChats:
+    """Chats alerts can't be delivered to, and chats that moved to a new ID.
+
+    Kept in memory for lookups on every delivery and persisted to the
+    bot's SQLite database.
+    """
+
+    def __init__(self):
+        self.db = database.connect()
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS dead_chats (
+                    chat_id INTEGER PRIMARY KEY,
+                    reason TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS chat_migrations (
+                    old_chat_id INTEGER PRIMARY KEY,
+                    new_chat_id INTEGER NOT NULL
+                );
+                """
+            )
+            self.dead = dict(self.db.execute("SELECT chat_id, reason FROM dead_chats"))
+            self.migrations = dict(
+                self.db.execute("SELECT old_chat_id, new_chat_id FROM chat_migrations")
+            )
+
+    def resolve(self, chat_id: int) -> int:
+        """Follows migrations to the chat's current ID."""
+        seen = set()
+        while chat_id in self.migrations and chat_id not in seen:
+            seen.add(chat_id)
+            chat_id = self.migrations[chat_id]
+        return chat_id
+
+    def reason(self, chat_id: int):
+        """Returns why the chat is unreachable, or None if it isn't known to be."""
+        return self.dead.get(chat_id)
+
+    def mark_dead(self, chat_id: int, reason: str):
+        logger.warning(f"Chat {chat_id} is unreachable: {reason}")
+        with self.lock, self.db:
+            self.dead[chat_id] = reason
+            self.db.execute(
+                "INSERT OR REPLACE INTO dead_chats (chat_id, reason, created_at) VALUES (?, ?, ?)",
+                (chat_id, reason, time.time()),
+            )
+
+    def revive(self, chat_id: int):
+        """Forgets that a chat was unreachable, e.g. when it subscribes again."""
+        if chat_id not in self.dead:
+            return
+        with self.lock, self.db:
+            self.dead.pop(chat_id, None)
+            self.db.execute("DELETE FROM dead_chats WHERE chat_id = ?", (chat_id,))
+
+    def migrate(self, old_chat_id: int, new_chat_id: int):
+        logger.info(f"Chat {old_chat_id} migrated to {new_chat_id}")
+        with self.lock, self.db:
+            self.migrations[old_chat_id] = new_chat_id
+            self.db.execute(
+                "INSERT OR REPLACE INTO chat_migrations (old_chat_id, new_chat_id) VALUES (?, ?)",
+                (old_chat_id, new_chat_id),
+            )
+
+    def stats(self) -> dict:
+        return {
+            "dead": len(self.dead),
+            "migrated": len(self.migrations),
+        }
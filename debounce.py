@@ -0,0 +1,58 @@
+import asyncio
+import functools
+
+
+class Debouncer:
+    """Lets only the latest call per key through after a quiet period.
+
+    A newer call for the same key cancels the older one, whether it is
+    still waiting out the quiet period or already running.
+    """
+
+    def __init__(self, quiet_period: float):
+        self.quiet_period = quiet_period
+        # Superseded while waiting, so they never reached upstream
+        self.debounced = 0
+        # Superseded after they had already started running
+        self.cancelled = 0
+        self.passed = 0
+        self._tasks = {}
+        self._running = set()
+
+    async def wait(self, key):
+        """Waits out the quiet period for key.
+
+        Raises CancelledError in the calling task if a newer call for the
+        same key arrives before the calling task finishes.
+        """
+        previous = self._tasks.get(key)
+        if previous is not None and not previous.done():
+            if previous in self._running:
+                self.cancelled += 1
+            else:
+                self.debounced += 1
+            previous.cancel()
+
+        task = asyncio.current_task()
+        self._tasks[key] = task
+        task.add_done_callback(functools.partial(self._forget, key))
+
+        await asyncio.sleep(self.quiet_period)
+        self._running.add(task)
+        self.passed += 1
+
+    def is_latest(self, key) -> bool:
+        return self._tasks.get(key) is asyncio.current_task()
+
+    def _forget(self, key, task):
+        self._running.discard(task)
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def stats(self) -> dict:
+        return {
+            "debounced": self.debounced,
+            "cancelled": self.cancelled,
+            "passed": self.passed,
+            "pending": len(self._tasks),
+        }
@@ -0,0 +1,109 @@
+import logging
+import time
+from collections import OrderedDict
+
+from telegram import Message
+from telegram.error import BadRequest
+
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """Persistent LRU map from photo URLs and paths to Telegram file_ids."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = database.connect()
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS file_ids (
+                    photo TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    used_at REAL NOT NULL
+                )
+                """
+            )
+        rows = self.db.execute(
+            "SELECT photo, file_id FROM file_ids ORDER BY used_at"
+        ).fetchall()
+        self._entries = OrderedDict(rows)
+
+    def __contains__(self, photo: str):
+        return photo in self._entries
+
+    def get(self, photo: str):
+        file_id = self._entries.get(photo)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(photo)
+        with self.db:
+            self.db.execute(
+                "UPDATE file_ids SET used_at = ? WHERE photo = ?", (time.time(), photo)
+            )
+        return file_id
+
+    def set(self, photo: str, file_id: str):
+        self._entries[photo] = file_id
+        self._entries.move_to_end(photo)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_ids (photo, file_id, used_at) VALUES (?, ?, ?)",
+                (photo, file_id, time.time()),
+            )
+            while len(self._entries) > self.max_entries:
+                oldest, _ = self._entries.popitem(last=False)
+                self.db.execute("DELETE FROM file_ids WHERE photo = ?", (oldest,))
+
+    def delete(self, photo: str):
+        self._entries.pop(photo, None)
+        with self.db:
+            self.db.execute("DELETE FROM file_ids WHERE photo = ?", (photo,))
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def photo_key(photo) -> str:
+    return str(photo)
+
+
+async def reply_photo(cache: FileIdCache, message: Message, photo, caption=None):
+    """Replies with a photo, sending it by file_id if it has been sent before.
+
+    photo is a URL or a pathlib.Path to a local file.
+    """
+    key = photo_key(photo)
+    file_id = cache.get(key)
+    if file_id is not None:
+        try:
+            return await message.reply_photo(file_id, caption)
+        except BadRequest as e:
+            logger.info(f"Cached file_id for {key} rejected: {str(e)}")
+            cache.delete(key)
+
+    sent = await message.reply_photo(photo, caption)
+    cache.set(key, sent.photo[-1].file_id)
+    return sent
+
+
+async def upload_photos(cache: FileIdCache, bot, chat_id: int, photos: list):
+    """Uploads photos that don't have a file_id yet through a scratch chat."""
+    for photo in photos:
+        key = photo_key(photo)
+        if key in cache:
+            continue
+        sent = await bot.send_photo(chat_id, photo, disable_notification=True)
+        cache.set(key, sent.photo[-1].file_id)
+        await sent.delete()
+        logger.info(f"Uploaded {key} as {cache.get(key)}")
@@ -0,0 +1,31 @@
+import httpx
+
+import settings
+
+# Keep-alive pool shared by every outbound call made from the event loop
+LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=60,
+)
+
+_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Returns the process-wide async HTTP client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=settings.REQUEST_TIMEOUT,
+            limits=LIMITS,
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
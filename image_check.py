@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+import httpx
+
+import settings
+from cache import MISSING, TTLCache
+from http_client import get_client
+
+logger = logging.getLogger(__name__)
+
+# Formats Telegram accepts for photos sent by URL, and its size limit for them
+PHOTO_CONTENT_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp"}
+MAX_PHOTO_SIZE = 5 * 1024 * 1024
+
+# Hosts with this many failed checks are skipped until their entry expires
+MAX_HOST_FAILURES = 3
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5)"
+    "AppleWebKit/537.36 (KHTML, like Gecko)"
+    "Chrome/50.0.2661.102 Safari/537.36"
+}
+
+URL_RESULTS = TTLCache(max_bytes=1024 * 1024, default_ttl=settings.IMAGE_CHECK_CACHE_TTL)
+
+HOST_FAILURES = TTLCache(max_bytes=256 * 1024, default_ttl=settings.IMAGE_CHECK_CACHE_TTL)
+
+
+def is_photo_response(response: httpx.Response) -> bool:
+    if response.status_code >= 400:
+        return False
+
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type not in PHOTO_CONTENT_TYPES:
+        return False
+
+    # Ranged responses carry the full size after the slash in Content-Range
+    size = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if not size.isdigit():
+        size = response.headers.get("Content-Length", "")
+    return not size.isdigit() or int(size) <= MAX_PHOTO_SIZE
+
+
+async def fetch_is_photo(url: str) -> bool:
+    client = get_client()
+    try:
+        response = await client.head(url, headers=HEADERS)
+        if response.status_code < 400 and "Content-Type" in response.headers:
+            return is_photo_response(response)
+
+        # Some hosts don't answer HEAD properly, ask for the first byte instead
+        headers = dict(HEADERS, Range="bytes=0-0")
+        async with client.stream("GET", url, headers=headers) as response:
+            return is_photo_response(response)
+    # InvalidURL isn't an HTTPError, malformed search links raise it
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError) as e:
+        logger.info(f"Image check failed for {url}: {repr(e)}")
+        return False
+
+
+def url_host(url: str):
+    """Returns the URL's host, or None if it has none or can't be parsed."""
+    try:
+        return urlsplit(url).hostname
+    except ValueError:
+        # E.g. an unclosed IPv6 bracket
+        return None
+
+
+def mark_bad(url: str):
+    URL_RESULTS.set(url, False)
+    host = url_host(url)
+    if host is not None:
+        HOST_FAILURES.set(host, HOST_FAILURES.get(host, 0) + 1)
+
+
+async def is_valid_photo_url(url: str) -> bool:
+    valid = URL_RESULTS.get(url)
+    if valid is not MISSING:
+        return valid
+
+    host = url_host(url)
+    if host is None:
+        URL_RESULTS.set(url, False)
+        return False
+    if HOST_FAILURES.get(host, 0) >= MAX_HOST_FAILURES:
+        return False
+
+    valid = await fetch_is_photo(url)
+    if valid:
+        URL_RESULTS.set(url, True)
+    else:
+        mark_bad(url)
+    return valid
+
+
+async def first_valid_photo_url(urls: list, known=()):
+    """Checks the top candidates concurrently and returns the best ranked valid one.
+
+    URLs in known, e.g. ones Telegram already has a file_id for, are valid
+    without checking. Returns None if none of them is valid within
+    IMAGE_CHECK_TIMEOUT.
+    """
+
+    async def check_url(url):
+        return url in known or await is_valid_photo_url(url)
+
+    candidates = urls[: settings.IMAGE_CHECK_CANDIDATES]
+    checks = [asyncio.ensure_future(check_url(url)) for url in candidates]
+    try:
+        async with asyncio.timeout(settings.IMAGE_CHECK_TIMEOUT):
+            for url, check in zip(candidates, checks):
+                if await check:
+                    return url
+    except TimeoutError:
+        # Settle for the best candidate that has been confirmed so far
+        for url, check in zip(candidates, checks):
+            if check.done() and not check.cancelled() and check.result():
+                return url
+    finally:
+        for check in checks:
+            check.cancel()
+    return None
+
+
+def stats() -> dict:
+    return {
+        "urls": URL_RESULTS.stats(),
+        "hosts": HOST_FAILURES.stats(),
+    }
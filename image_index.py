@@ -0,0 +1,128 @@
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def pack_items(items: list) -> str:
+    pairs = [[item["link"], item["image"]["thumbnailLink"]] for item in items]
+    return json.dumps(pairs, separators=(",", ":"))
+
+
+def unpack_items(packed: str) -> list:
+    return [
+        {"link": link, "image": {"thumbnailLink": thumbnail_link}}
+        for link, thumbnail_link in json.loads(packed)
+    ]
+
+
+class ImageIndex:
+    """On-disk full text index from past search queries to their image results.
+
+    Used to answer searches locally when Google can't be asked.
+    """
+
+    def __init__(self, path: str, max_queries: int):
+        self.path = path
+        self.max_queries = max_queries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS queries (
+                id INTEGER PRIMARY KEY,
+                query TEXT NOT NULL UNIQUE,
+                items TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS queries_updated_at ON queries (updated_at);
+            CREATE VIRTUAL TABLE IF NOT EXISTS query_tokens USING fts5 (
+                query, content='queries', content_rowid='id'
+            );
+            """
+        )
+        self.count = self.db.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+
+    def record(self, query: str, items: list):
+        """Stores the results of a normalized query, replacing older results."""
+        now = time.time()
+        with self.db:
+            row = self.db.execute(
+                "SELECT id FROM queries WHERE query = ?", (query,)
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    "UPDATE queries SET items = ?, updated_at = ? WHERE id = ?",
+                    (pack_items(items), now, row[0]),
+                )
+                return
+
+            cursor = self.db.execute(
+                "INSERT INTO queries (query, items, updated_at) VALUES (?, ?, ?)",
+                (query, pack_items(items), now),
+            )
+            self.db.execute(
+                "INSERT INTO query_tokens (rowid, query) VALUES (?, ?)",
+                (cursor.lastrowid, query),
+            )
+            self.count += 1
+            if self.count > self.max_queries:
+                self.evict(self.count - self.max_queries)
+
+    def evict(self, count: int):
+        oldest = self.db.execute(
+            "SELECT id, query FROM queries ORDER BY updated_at LIMIT ?", (count,)
+        ).fetchall()
+        self.db.executemany(
+            "INSERT INTO query_tokens (query_tokens, rowid, query) VALUES ('delete', ?, ?)",
+            oldest,
+        )
+        self.db.executemany(
+            "DELETE FROM queries WHERE id = ?", [(row_id,) for row_id, _ in oldest]
+        )
+        self.count -= len(oldest)
+
+    def lookup(self, query: str):
+        """Returns the results of the closest past query, or None."""
+        tokens = ['"{}"'.format(token.replace('"', '""')) for token in query.split()]
+        if not tokens:
+            return None
+
+        row = self.db.execute(
+            "SELECT items FROM queries WHERE query = ?", (query,)
+        ).fetchone()
+        try:
+            # Prefer past queries containing every token, then any of them
+            for match in (" ".join(tokens), " OR ".join(tokens)):
+                if row is not None:
+                    break
+                row = self.db.execute(
+                    """
+                    SELECT queries.items FROM (
+                        SELECT rowid FROM query_tokens
+                        WHERE query_tokens MATCH ? ORDER BY rank LIMIT 1
+                    ) AS best
+                    JOIN queries ON queries.id = best.rowid
+                    """,
+                    (match,),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Image index lookup failed: {repr(e)}")
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return unpack_items(row[0])
+
+    def stats(self) -> dict:
+        return {
+            "queries": self.count,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+
+import settings
+from cache import MISSING, TTLCache
+from circuit_breaker import breaker
+from http_client import get_client
+from image_index import ImageIndex
+from search_quota import QuotaPool
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TYPE = "image"
+GL = "fi"
+
+# Custom Search returns at most 10 items per page and 100 items per query
+PAGE_SIZE = 10
+MAX_START = 91
+
+SEARCH_CACHE = TTLCache(
+    max_bytes=settings.SEARCH_CACHE_MAX_BYTES,
+    default_ttl=settings.SEARCH_CACHE_TTL,
+)
+
+SEARCH_FLIGHTS = SingleFlight("google_search")
+
+QUOTA = QuotaPool(
+    keys=settings.GOOGLE_SEARCH_KEYS,
+    daily_limit=settings.GOOGLE_SEARCH_DAILY_LIMIT,
+    path=settings.GOOGLE_SEARCH_QUOTA_FILE,
+)
+
+INDEX = ImageIndex(
+    path=settings.IMAGE_INDEX_PATH,
+    max_queries=settings.IMAGE_INDEX_MAX_QUERIES,
+)
+
+GOOGLE_BREAKER = breaker("google")
+
+# Monotonic deadline until which all keys are known to be out of quota
+quota_exhausted_until = 0.0
+
+
+class IndexedItems(list):
+    """Result items of the closest past query, returned when Google couldn't answer."""
+
+
+def normalize_query(search_terms: str) -> str:
+    return " ".join(search_terms.casefold().split())
+
+
+def slim_items(items: list) -> list:
+    """Keeps only the fields the handlers use from the search result items."""
+    return [
+        {
+            "link": item["link"],
+            "image": {"thumbnailLink": item["image"]["thumbnailLink"]},
+        }
+        for item in items
+    ]
+
+
+async def google_search(search_terms: str, start: int = 1):
+    """Uses Google Custom Search API to find images.
+
+    Returns the list of result items, None when nothing was found,
+    -1 when the daily limit has been reached and -2 on any other error.
+    start is the 1-based index of the first result, for paging.
+    Results are cached per normalized query and page. When Google can't
+    answer the first page, results of the closest past query are
+    returned instead, as IndexedItems.
+    """
+    query = normalize_query(search_terms)
+    if time.monotonic() < quota_exhausted_until:
+        QUOTA.skipped += 1
+        items = -1
+    else:
+        key = (query, SEARCH_TYPE, GL, start)
+        items = SEARCH_CACHE.get(key)
+        if items is MISSING:
+            items = await SEARCH_FLIGHTS.do(key, search_and_cache, key, search_terms)
+
+    if items in (-1, -2) and start == 1:
+        indexed = INDEX.lookup(query)
+        if indexed:
+            return IndexedItems(indexed)
+    return items
+
+
+async def search_and_cache(key: tuple, search_terms: str):
+    global quota_exhausted_until
+
+    query, _, _, start = key
+    items = await fetch_google_search(search_terms, start)
+    if isinstance(items, list):
+        items = slim_items(items)
+        SEARCH_CACHE.set(key, items)
+        if start == 1:
+            INDEX.record(query, items)
+    elif items is None:
+        SEARCH_CACHE.set(key, None, ttl=settings.SEARCH_CACHE_NOT_FOUND_TTL)
+    elif items == -1:
+        quota_exhausted_until = time.monotonic() + QUOTA.seconds_until_available()
+    return items
+
+
+async def fetch_google_search(search_terms: str, start: int = 1):
+    if not GOOGLE_BREAKER.allow():
+        return -2
+    started = time.monotonic()
+    healthy = None
+    try:
+        items, healthy = await query_google_search(search_terms, start)
+    finally:
+        GOOGLE_BREAKER.record(started, healthy)
+    return items
+
+
+async def query_google_search(search_terms: str, start: int = 1) -> tuple:
+    """Returns the fetch_google_search result and whether Google answered properly.
+
+    Running out of quota or a rejected request says nothing about whether
+    Google is up, so its health is None then.
+    """
+    # Try each key with quota left until one of them answers
+    for _ in settings.GOOGLE_SEARCH_KEYS:
+        credentials = QUOTA.acquire()
+        if credentials is None:
+            break
+
+        key, cx = credentials
+        params = {
+            "q": search_terms,
+            "key": key,
+            "cx": cx,
+            "searchType": SEARCH_TYPE,
+            "gl": GL,
+            "start": start,
+            "num": PAGE_SIZE,
+        }
+        try:
+            async with asyncio.timeout(settings.SEARCH_TIMEOUT):
+                response = await get_client().get(settings.GOOGLE_SEARCH_URL, params=params)
+            json_response = response.json()
+        except Exception as e:
+            logger.exception("Exception while processing google search: " + repr(e))
+            return -2, False
+
+        if "items" in json_response:
+            return json_response["items"], True
+        elif "error" in json_response:
+            error = json_response["error"]
+            message = error.get("message", "")
+            if "billing" in message or "per day" in message:
+                QUOTA.mark_exhausted(key)
+                continue
+            elif error.get("code") == 429:
+                QUOTA.cool_down(key)
+                continue
+            # Any other error is passing, it must not be cached as "no results"
+            logger.warning(f"Google search error {error.get('code')}: {message}")
+            # Our own bad requests don't mean Google is down
+            code = error.get("code")
+            return -2, None if isinstance(code, int) and 400 <= code < 500 else False
+        return None, True
+
+    # A per-minute rate limit on every key isn't the daily limit the user would be told about
+    if not QUOTA.daily_quota_spent():
+        return -2, None
+    return -1, None
@@ -0,0 +1,171 @@
+"""
+In-process metrics rendered in the Prometheus text format.
+
+Observing a value is a bucket search and a few additions under a lock, so
+metrics can be recorded on the hot path. Values that other modules
+already count, like cache hits, are read from them when scraped instead.
+"""
+
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+METRICS = {}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        METRICS[name] = self
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {escape(self.documentation)}", f"# TYPE {self.name} {self.type}"]
+        return lines + self.samples()
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> list:
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Labels to per-bucket counts, the last one past the highest bound, and the sum
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[idx] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Callback(Metric):
+    """Reads its values when scraped from fn, which returns a number or a labels to number dict."""
+
+    def __init__(self, name: str, documentation: str, fn, kind: str = "gauge", labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self.type = kind
+
+    def samples(self) -> list:
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+            for labels, value in values.items()
+        ]
+
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Time spent handling an update", ("handler",))
+
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised an exception", ("handler",))
+
+EVENT_LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds",
+    "How late the event loop woke up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+def timed(handler):
+    """Records the latency and errors of an update handler under its name.
+
+    Cancelled handlers, like superseded inline queries, aren't recorded.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+            raise
+        HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+        return result
+
+    return wrapper
+
+
+async def monitor_event_loop_lag(interval: float):
+    """Measures how much later than asked the event loop wakes a sleeper, every interval seconds."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(time.perf_counter() - started - interval, 0.0))
+
+
+def render() -> str:
+    lines = []
+    for metric in list(METRICS.values()):
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
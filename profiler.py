@@ -0,0 +1,205 @@
+"""
+Profiling that can be switched on in production through the admin endpoints.
+
+Results are collapsed stacks, one "root;...;leaf count" line per distinct
+stack, which flamegraph.pl and speedscope read as is.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+# Innermost frames kept in a blocking call report
+REPORT_FRAMES = 30
+
+
+def frame_name(code) -> str:
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_frame(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def collapse_await_chain(coroutine) -> str:
+    """Collapses the chain of coroutines coroutine is awaiting, ending in what it waits on."""
+    names = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(coroutine, "gi_frame", None)
+        if frame is None:
+            # A future, or a coroutine that has just finished
+            names.append(f"<{type(coroutine).__name__}>")
+            break
+        names.append(frame_name(frame.f_code))
+        coroutine = getattr(coroutine, "cr_await", None) or getattr(coroutine, "gi_yieldfrom", None)
+    return ";".join(names)
+
+
+def current_lines(frame) -> list:
+    lines = []
+    while frame is not None:
+        lines.append(f"{frame.f_code.co_qualname} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return lines[::-1]
+
+
+def format_collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def sample_stacks(thread_ids, seconds: float, interval: float) -> Counter:
+    """Samples the stacks of the given threads, or all other threads if None. Blocks for seconds."""
+    stacks = Counter()
+    own_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id and (thread_ids is None or thread_id in thread_ids):
+                stacks[collapse_frame(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class UpdateProfiler:
+    """Samples where the next updates of chosen handlers spend their time.
+
+    The await chain of each profiled handler is sampled from the event loop,
+    so the stacks show what the handler is waiting on, e.g. an HTTP request.
+    Time the handler blocks the loop shows up as a gap between samples and
+    is what BlockingCallDetector reports.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.armed = {}
+        self.stacks = {}
+        self.updates = {}
+        self.seconds = {}
+        self.running = {}
+        self.sampler = None
+
+    def arm(self, handler_name: str, count: int):
+        """Profiles the next count updates of the handler, dropping its earlier results."""
+        self.armed[handler_name] = count
+        self.stacks[handler_name] = Counter()
+        self.updates[handler_name] = 0
+        self.seconds[handler_name] = 0.0
+
+    def results(self, handler_name: str):
+        if handler_name not in self.stacks:
+            return None
+        return {
+            "remaining": self.armed.get(handler_name, 0),
+            "updates": self.updates[handler_name],
+            "seconds": self.seconds[handler_name],
+            "stacks": format_collapsed(self.stacks[handler_name]),
+        }
+
+    def profiled(self, handler):
+        name = handler.__name__
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            if not self.armed.get(name):
+                return await handler(*args, **kwargs)
+
+            self.armed[name] -= 1
+            coroutine = handler(*args, **kwargs)
+            self.running[coroutine] = name
+            if self.sampler is None:
+                self.sampler = asyncio.create_task(self.sample())
+            started = time.perf_counter()
+            try:
+                return await coroutine
+            finally:
+                del self.running[coroutine]
+                self.updates[name] += 1
+                self.seconds[name] += time.perf_counter() - started
+
+        return wrapper
+
+    async def sample(self):
+        try:
+            while self.running:
+                await asyncio.sleep(self.interval)
+                for coroutine, name in list(self.running.items()):
+                    self.stacks[name][collapse_await_chain(coroutine)] += 1
+        finally:
+            self.sampler = None
+
+
+class BlockingCallDetector:
+    """Reports code that keeps the event loop from running for longer than a threshold.
+
+    The loop bumps a timestamp every half threshold and a watchdog thread
+    captures the loop thread's stack when the timestamp falls behind.
+    """
+
+    def __init__(self, max_reports: int):
+        self.threshold = 0.0
+        self.detected = 0
+        self.reports = deque(maxlen=max_reports)
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_tick = 0.0
+        self.tick_handle = None
+        self.generation = 0
+
+    def start(self, threshold: float):
+        """Starts watching the running loop, or changes the threshold. Call on the loop."""
+        self.stop()
+        self.threshold = threshold
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.tick()
+        watchdog = threading.Thread(target=self.watch, args=(self.generation,), name="blocking-call-detector")
+        watchdog.daemon = True
+        watchdog.start()
+
+    def stop(self):
+        # A running watchdog notices the new generation and exits
+        self.generation += 1
+        self.threshold = 0.0
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+
+    def tick(self):
+        self.last_tick = time.monotonic()
+        self.tick_handle = self.loop.call_later(self.threshold / 2, self.tick)
+
+    def watch(self, generation: int):
+        reported_tick = None
+        while generation == self.generation:
+            threshold = self.threshold
+            time.sleep(threshold / 2)
+            last_tick = self.last_tick
+            blocked = time.monotonic() - last_tick - threshold / 2
+            if blocked < threshold or last_tick == reported_tick or generation != self.generation:
+                continue
+            reported_tick = last_tick
+            frame = sys._current_frames().get(self.loop_thread_id)
+            # Line numbers of the call in progress, to find the blocking call itself
+            stack = current_lines(frame)[-REPORT_FRAMES:]
+            self.detected += 1
+            # blocked_for is how long the loop had been blocked when the stack was captured
+            self.reports.append({"at": time.time(), "blocked_for": round(blocked, 3), "stack": stack})
+            logger.warning(f"Event loop blocked for {blocked:.3f}s in {stack[-1] if stack else 'unknown'}")
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "detected": self.detected,
+            "reports": list(self.reports),
+        }
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket that queues callers instead of rejecting them.
+
+    Each caller reserves a token up front, going into debt if needed, and
+    sleeps until its token would have been refilled. Waiters are served in
+    arrival order without polling.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it."""
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Holds back every caller for at least seconds, e.g. when the server asks us to."""
+        self.refill()
+        # The next reservation takes a token and waits for the debt to refill
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    async def acquire(self) -> float:
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+    async def acquire_spare(self) -> float:
+        """Waits for a free token and takes it without going into debt.
+
+        Callers of acquire() that are queued or arrive meanwhile are served
+        first, so background work never holds them back.
+        """
+        waited = 0.0
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            delay = (1 - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+    @property
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
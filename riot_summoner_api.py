@@ -2,8 +2,13 @@ import riotwatcher
 from riotwatcher import LolWatcher
 
 import settings
+from singleflight import single_flight
 
 
+@single_flight(
+    "riot_summoner",
+    key=lambda summoner_name, region="euw1": (summoner_name, region),
+)
 def get_summoner_match_info(summoner_name: str, region: str = "euw1") -> list:
     watcher = LolWatcher(settings.RIOT_API_KEY)
 
@@ -15,6 +20,9 @@ def get_summoner_match_info(summoner_name: str, region: str = "euw1") -> list:
         )
     except riotwatcher.ApiError as e:
         print(str(e))
+        # Outages are left to the caller's circuit breaker
+        if e.response is not None and e.response.status_code >= 500:
+            raise
         return "APIError when querying Riot API"
 
     all_match_details = []
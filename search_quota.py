@@ -0,0 +1,181 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# Custom Search quotas reset at midnight Pacific Time
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+# How long a key rests after a per-minute rate limit error
+RATE_LIMIT_COOL_DOWN = 60
+
+
+def quota_day() -> str:
+    return datetime.datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+
+def seconds_until_quota_reset() -> float:
+    now = datetime.datetime.now(QUOTA_TIMEZONE)
+    tomorrow = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time(), QUOTA_TIMEZONE
+    )
+    return (tomorrow - now).total_seconds()
+
+
+def key_id(key: str) -> str:
+    # Persist a fingerprint instead of the API key itself
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+class QuotaPool:
+    """Spreads Custom Search requests over several key/CX pairs.
+
+    Requests are counted per key for each quota day. Keys that report a
+    billing or daily limit error are skipped until the day rolls over,
+    and the state is saved to disk so a restart doesn't reset the counts.
+    Exhausted keys and day rollovers are saved at once, request counts by
+    run_flush().
+    """
+
+    def __init__(self, keys: list, daily_limit: int, path: str):
+        self.keys = keys
+        self.daily_limit = daily_limit
+        self.path = path
+        self.day = None
+        self.counts = {}
+        self.exhausted = set()
+        self.cooling_until = {}
+        self.dirty = False
+        # Searches answered as over quota without asking Google
+        self.skipped = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load search quota state: {repr(e)}")
+            return
+        self.day = state.get("day")
+        self.counts = state.get("counts", {})
+        self.exhausted = set(state.get("exhausted", []))
+
+    def snapshot(self) -> dict:
+        self.dirty = False
+        return {
+            "day": self.day,
+            "skipped": self.skipped,
+            "counts": dict(self.counts),
+            "exhausted": sorted(self.exhausted),
+        }
+
+    def save(self):
+        self.write(self.snapshot())
+
+    def write(self, state: dict):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save search quota state: {repr(e)}")
+
+    def roll_over(self):
+        day = quota_day()
+        if day != self.day:
+            self.day = day
+            self.counts = {}
+            self.exhausted = set()
+            self.cooling_until = {}
+            self.save()
+
+    def available(self) -> list:
+        now = time.monotonic()
+        return [
+            (key, cx)
+            for key, cx in self.keys
+            if key_id(key) not in self.exhausted
+            and self.counts.get(key_id(key), 0) < self.daily_limit
+            and self.cooling_until.get(key_id(key), 0) <= now
+        ]
+
+    def acquire(self):
+        """Returns the least used key/CX pair with quota left, or None."""
+        self.roll_over()
+        available = self.available()
+        if not available:
+            return None
+
+        key, cx = min(available, key=lambda pair: self.counts.get(key_id(pair[0]), 0))
+        self.counts[key_id(key)] = self.counts.get(key_id(key), 0) + 1
+        self.dirty = True
+        return key, cx
+
+    def mark_exhausted(self, key: str):
+        logger.warning(f"Search key {key_id(key)} exhausted for {self.day}")
+        self.exhausted.add(key_id(key))
+        self.save()
+
+    def cool_down(self, key: str, seconds: float = RATE_LIMIT_COOL_DOWN):
+        logger.warning(f"Search key {key_id(key)} rate limited, resting {seconds}s")
+        self.cooling_until[key_id(key)] = time.monotonic() + seconds
+
+    def daily_quota_spent(self) -> bool:
+        """Whether every key is out of quota for the day, not just resting after a rate limit."""
+        self.roll_over()
+        return all(
+            key_id(key) in self.exhausted or self.counts.get(key_id(key), 0) >= self.daily_limit
+            for key, _ in self.keys
+        )
+
+    async def flush(self):
+        """Saves request counts changed since the last save, off the event loop."""
+        if self.dirty:
+            await asyncio.to_thread(self.write, self.snapshot())
+
+    async def run_flush(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def seconds_until_available(self) -> float:
+        """How long until some key can be used again."""
+        self.roll_over()
+        if self.available():
+            return 0.0
+
+        now = time.monotonic()
+        cooling = [
+            until - now
+            for key, _ in self.keys
+            if key_id(key) not in self.exhausted
+            and self.counts.get(key_id(key), 0) < self.daily_limit
+            and (until := self.cooling_until.get(key_id(key), 0)) > now
+        ]
+        if cooling:
+            return min(cooling)
+        return seconds_until_quota_reset()
+
+    def stats(self) -> dict:
+        return {
+            "day": self.day,
+            "skipped": self.skipped,
+            "keys": [
+                {
+                    "key": key_id(key),
+                    "requests": self.counts.get(key_id(key), 0),
+                    "exhausted": key_id(key) in self.exhausted,
+                }
+                for key, _ in self.keys
+            ],
+        }
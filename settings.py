@@ -1,6 +1,6 @@
 import os
 
-from environs import Env
+from environs import Env, EnvError
 
 env = Env()
 
@@ -10,6 +10,112 @@ if os.path.exists(".env"):
 
 REQUEST_TIMEOUT = 30
 
+# Upper bound for a single Google search, including connection setup
+SEARCH_TIMEOUT = 5
+
+# Google search result cache
+SEARCH_CACHE_TTL = 6 * 60 * 60
+SEARCH_CACHE_NOT_FOUND_TTL = 10 * 60
+SEARCH_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# /img checks this many results concurrently and sends the first valid one
+IMAGE_CHECK_CANDIDATES = 3
+
+IMAGE_CHECK_TIMEOUT = 2
+
+IMAGE_CHECK_CACHE_TTL = 6 * 60 * 60
+
+FILE_ID_CACHE_SIZE = 10000
+
+# Chat used to upload the bundled images at startup, they are uploaded
+# on first use if this isn't set
+PHOTO_UPLOAD_CHAT_ID = env.int("PHOTO_UPLOAD_CHAT_ID", None)
+
+# How long Telegram may cache our answers to inline queries
+INLINE_CACHE_TIME = 60 * 60
+
+# Inline queries are searched once the user stops typing for this long
+INLINE_QUERY_QUIET_PERIOD = env.float("INLINE_QUERY_QUIET_PERIOD", 0.4)
+
+# How long an unsubmitted category selection is kept
+CATEGORY_SELECTION_TTL = 60 * 60
+
+# How often expired entries nobody looked up again are dropped from the caches
+CACHE_PURGE_INTERVAL = 5 * 60
+
+# Past search results used when Google search is unavailable
+IMAGE_INDEX_PATH = env("IMAGE_INDEX_PATH", "image_index.db")
+
+IMAGE_INDEX_MAX_QUERIES = 50000
+
+# Alert delivery
+ALERT_CONCURRENCY = 20
+
+ALERT_MAX_ATTEMPTS = 8
+
+# Delay before the first retry of a failed delivery, doubled on each retry
+ALERT_RETRY_DELAY = 5
+
+# Alerts to the same chat within this many seconds are merged into one
+# digest, 0 sends every alert on its own
+ALERT_DIGEST_WINDOW = env.float("ALERT_DIGEST_WINDOW", 0)
+
+# How often the local subscription index is reconciled with Tarjoushaukka, 0 disables.
+# Off by default, it relies on the format of Tarjoushaukka's GET /chat.
+SUBSCRIPTION_RECONCILE_INTERVAL = env.int("SUBSCRIPTION_RECONCILE_INTERVAL", 0)
+
+# Tarjoushaukka requests, subscription changes made while it's down are retried every replay interval
+TARJOUSHAUKKA_TIMEOUT = 5
+TARJOUSHAUKKA_CONNECT_TIMEOUT = 2
+TARJOUSHAUKKA_RETRIES = 2
+TARJOUSHAUKKA_REPLAY_INTERVAL = 60
+
+# How many recent webhook update IDs are remembered to drop redeliveries
+WEBHOOK_RECENT_UPDATES = 10000
+
+# How long in-flight requests, updates and alerts get to finish on shutdown
+SHUTDOWN_TIMEOUT = 30
+
+# Updates from different chats are handled concurrently up to this limit,
+# updates beyond the pending limit wait in the update queue
+MAX_CONCURRENT_UPDATES = env.int("MAX_CONCURRENT_UPDATES", 32)
+MAX_PENDING_UPDATES = 1024
+
+# Handlers running at once, handlers waiting for a turn and how many seconds
+# one may wait per command class. Commands over the limit get a busy reply,
+# inline queries over it go unanswered.
+BULKHEADS = {
+    "ask": {"max_concurrent": 4, "max_queued": 8, "deadline": 20},
+    "img": {"max_concurrent": 8, "max_queued": 16, "deadline": 10},
+    "inline": {"max_concurrent": 8, "max_queued": 32, "deadline": 5},
+    "scrape": {"max_concurrent": 4, "max_queued": 8, "deadline": 10},
+}
+
+# A dependency's circuit opens after this many consecutive failures and
+# lets one probe request through after the reset timeout
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# How often the event loop's lag is sampled for /metrics
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# Sentry traces per route or handler and minute, frequent ones are sampled down to it
+SENTRY_TRACES_PER_MINUTE = env.float("SENTRY_TRACES_PER_MINUTE", 10)
+
+# Admin profiling, intervals are between stack samples
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+UPDATE_PROFILE_INTERVAL = 0.01
+UPDATE_PROFILE_MAX_COUNT = 100
+
+# Code blocking the event loop longer than this many seconds is reported, 0 disables.
+# Lower thresholds would have the detector's own timer keep the loop busy.
+BLOCKING_CALL_THRESHOLD = env.float("BLOCKING_CALL_THRESHOLD", 0)
+BLOCKING_CALL_MIN_THRESHOLD = 0.01
+if 0 < BLOCKING_CALL_THRESHOLD < BLOCKING_CALL_MIN_THRESHOLD:
+    raise EnvError(f"BLOCKING_CALL_THRESHOLD must be 0 or at least {BLOCKING_CALL_MIN_THRESHOLD}")
+BLOCKING_CALL_REPORTS = 50
+
 # Environment variables
 PORT = env("PORT", 5002)
 
@@ -19,12 +125,37 @@ TARJOUSHAUKKA_URL = env("TARJOUSHAUKKA_URL", "http://192.168.1.16:5000")
 
 TELEGRAM_TOKEN = env("TOKEN", "test")
 
-TELEGRAM_HOOK = env("HOOK", "test")
+# Path of the webhook route, the bot polls for updates instead when this isn't set
+TELEGRAM_HOOK = env("HOOK", None)
+
+# Public base URL the webhook is registered under at startup, e.g. https://bot.example.com
+TELEGRAM_WEBHOOK_URL = env("HOOK_URL", None)
+
+# Telegram sends this in every webhook request, generated at startup if not set
+TELEGRAM_WEBHOOK_SECRET = env("HOOK_SECRET", None)
 
 GOOGLE_SEARCH_KEY = env("G_KEY", "test")
 
 GOOGLE_SEARCH_CX = env("G_CX", "test")
 
+# Comma separated KEY:CX pairs, used in turns as each runs out of daily quota
+GOOGLE_SEARCH_KEYS = [
+    tuple(pair.split(":", 1))
+    for pair in env.list("G_KEYS", [f"{GOOGLE_SEARCH_KEY}:{GOOGLE_SEARCH_CX}"])
+]
+if not all(len(credentials) == 2 and all(credentials) for credentials in GOOGLE_SEARCH_KEYS):
+    # The value isn't shown, it holds secret keys
+    raise EnvError("G_KEYS must be comma separated KEY:CX pairs")
+
+GOOGLE_SEARCH_DAILY_LIMIT = env.int("G_DAILY_LIMIT", 10000)
+
+GOOGLE_SEARCH_QUOTA_FILE = env("G_QUOTA_FILE", "search_quota.json")
+
+# How often search request counts are saved to GOOGLE_SEARCH_QUOTA_FILE
+GOOGLE_SEARCH_QUOTA_FLUSH_INTERVAL = 30
+
+GOOGLE_SEARCH_URL = env("G_URL", "https://www.googleapis.com/customsearch/v1")
+
 EXTERNAL_ENDPOINT_KEY = env("EXTERNAL_ENDPOINT_KEY", "test")
 
 SENTRY_DSN = env("SENTRY_DSN", "")
@@ -0,0 +1,124 @@
+import asyncio
+import functools
+import inspect
+import threading
+
+GROUPS = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one upstream call.
+
+    Callers that arrive while a call for their key is in flight wait for
+    it and share its result or exception.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.upstream_calls = 0
+        self.saved_calls = 0
+        self.cancelled_calls = 0
+        self._tasks = {}
+        self._waiters = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+        GROUPS[name] = self
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._tasks.get(key)
+        if task is None:
+            self.upstream_calls += 1
+            # Run upstream in its own task so a cancelled caller doesn't
+            # cancel the request for everyone else waiting on it
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.saved_calls += 1
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # Every caller has given up, so the result isn't needed
+                if not task.done():
+                    self.cancelled_calls += 1
+                    task.cancel()
+
+    def do_sync(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.upstream_calls += 1
+            else:
+                self.saved_calls += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "saved_calls": self.saved_calls,
+            "cancelled_calls": self.cancelled_calls,
+        }
+
+
+def single_flight(name: str, key=None):
+    """Decorates a sync or async function so identical concurrent calls are coalesced."""
+
+    def decorator(fn):
+        group = SingleFlight(name)
+
+        def make_key(args, kwargs):
+            if key is not None:
+                return key(*args, **kwargs)
+            return args, tuple(sorted(kwargs.items()))
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                return await group.do(make_key(args, kwargs), fn, *args, **kwargs)
+
+            async_wrapper.flights = group
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return group.do_sync(make_key(args, kwargs), fn, *args, **kwargs)
+
+        wrapper.flights = group
+        return wrapper
+
+    return decorator
+
+
+def stats() -> dict:
+    return {name: group.stats() for name, group in GROUPS.items()}
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+import time
+
+import database
+import tarjoushaukka
+from categories import CATEGORIES, category_bit
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionIndex:
+    """The bot's own copy of which chats subscribed to which categories.
+
+    Each chat maps to a bitmask of categories and each category to the set
+    of its chats, so alert recipients are resolved without asking
+    Tarjoushaukka. Persisted to the bot's SQLite database.
+
+    Changes that haven't reached Tarjoushaukka yet are flagged unsynced,
+    which makes the table an outbox replayed while Tarjoushaukka is down.
+    They win over Tarjoushaukka's state on reconciliation. Unsubscribed
+    chats are kept as empty masks until Tarjoushaukka knows about them.
+    """
+
+    def __init__(self):
+        self.db = database.connect()
+        self.lock = threading.Lock()
+        self.chats = {}
+        self.by_category = {idx: set() for idx in CATEGORIES}
+        self.unsynced = set()
+        with self.lock, self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    chat_id INTEGER PRIMARY KEY,
+                    categories INTEGER NOT NULL,
+                    synced INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            rows = self.db.execute("SELECT chat_id, categories, synced FROM subscriptions")
+            for chat_id, mask, synced in rows:
+                self.index(chat_id, mask)
+                if not synced:
+                    self.unsynced.add(chat_id)
+
+    def index(self, chat_id: int, mask: int):
+        old_mask = self.chats.pop(chat_id, 0)
+        for idx in CATEGORIES:
+            bit = category_bit(idx)
+            if old_mask & bit and not mask & bit:
+                self.by_category[idx].discard(chat_id)
+            elif mask & bit:
+                self.by_category[idx].add(chat_id)
+        if mask:
+            self.chats[chat_id] = mask
+
+    def store(self, chat_id: int, mask: int, synced: bool):
+        """Updates the chat's categories in memory and on disk. Call with the lock held."""
+        self.index(chat_id, mask)
+        if synced:
+            self.unsynced.discard(chat_id)
+        else:
+            self.unsynced.add(chat_id)
+
+        if not mask and synced:
+            self.db.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+        else:
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO subscriptions (chat_id, categories, synced, updated_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (chat_id, mask, int(synced), time.time()),
+            )
+
+    def subscribe(self, chat_id: int, mask: int, synced: bool = False):
+        with self.lock, self.db:
+            self.store(chat_id, mask, synced)
+
+    def unsubscribe(self, chat_id: int, synced: bool = False):
+        with self.lock, self.db:
+            if chat_id in self.chats or chat_id in self.unsynced or not synced:
+                self.store(chat_id, 0, synced)
+
+    def mark_synced(self, chat_id: int, mask: int):
+        """Flags the chat as known to Tarjoushaukka, unless it changed again since mask was sent."""
+        with self.lock, self.db:
+            if chat_id in self.unsynced and self.chats.get(chat_id, 0) == mask:
+                self.store(chat_id, mask, synced=True)
+
+    def migrate(self, old_chat_id: int, new_chat_id: int):
+        with self.lock, self.db:
+            mask = self.chats.get(old_chat_id, 0)
+            if mask:
+                self.store(new_chat_id, mask, synced=False)
+                self.store(old_chat_id, 0, synced=False)
+
+    def categories(self, chat_id: int) -> int:
+        return self.chats.get(chat_id, 0)
+
+    def recipients(self, category: int) -> list:
+        """Returns the chats subscribed to the category. Thread safe."""
+        with self.lock:
+            return list(self.by_category[category])
+
+    def reconcile(self, remote: dict) -> dict:
+        """Takes Tarjoushaukka's chat to category mask mapping as the truth.
+
+        Chats with local changes Tarjoushaukka hasn't seen are left alone and
+        returned as "unsynced" so they can be pushed to it.
+        """
+        drift = {"added": [], "changed": [], "removed": []}
+        with self.lock, self.db:
+            unsynced = set(self.unsynced)
+            for chat_id, mask in remote.items():
+                if chat_id in unsynced:
+                    continue
+                local_mask = self.chats.get(chat_id, 0)
+                if local_mask == mask:
+                    continue
+                drift["added" if not local_mask else "changed"].append(chat_id)
+                self.store(chat_id, mask, synced=True)
+
+            for chat_id in list(self.chats):
+                if chat_id not in remote and chat_id not in unsynced:
+                    drift["removed"].append(chat_id)
+                    self.store(chat_id, 0, synced=True)
+        drift["unsynced"] = sorted(unsynced)
+        return drift
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.chats),
+            "unsynced": len(self.unsynced),
+            "categories": {CATEGORIES[idx]: len(chats) for idx, chats in self.by_category.items()},
+        }
+
+
+async def push_subscription(index: SubscriptionIndex, chat_id: int) -> bool:
+    """Sends the chat's current subscription to Tarjoushaukka. Returns whether it got there."""
+    mask = index.categories(chat_id)
+    try:
+        if mask:
+            await tarjoushaukka.subscribe(chat_id, mask)
+        else:
+            await tarjoushaukka.unsubscribe(chat_id)
+    except tarjoushaukka.TarjoushaukkaError as e:
+        logger.warning(f"Could not send subscription of chat {chat_id}: {str(e)}")
+        return False
+    index.mark_synced(chat_id, mask)
+    return True
+
+
+async def replay(index: SubscriptionIndex) -> int:
+    """Sends unsynced changes to Tarjoushaukka, stopping at the first failure."""
+    pushed = 0
+    for chat_id in sorted(index.unsynced):
+        if not await push_subscription(index, chat_id):
+            break
+        pushed += 1
+    return pushed
+
+
+async def reconcile(index: SubscriptionIndex) -> dict:
+    """Fixes drift between the local index and Tarjoushaukka.
+
+    Local changes Tarjoushaukka missed are pushed to it, everything else is
+    taken from Tarjoushaukka.
+    """
+    remote = await tarjoushaukka.fetch_subscriptions()
+    # More likely a broken endpoint than every chat unsubscribing, so nothing is removed
+    if not remote and index.chats:
+        raise tarjoushaukka.TarjoushaukkaError("GET /chat returned no chats")
+    drift = index.reconcile(remote)
+    drift["pushed"] = await replay(index)
+    logger.info(
+        "Reconciled subscriptions: "
+        + ", ".join(f"{key} {len(value) if isinstance(value, list) else value}" for key, value in drift.items())
+    )
+    return drift
+
+
+async def run_reconciliation(index: SubscriptionIndex, interval: float):
+    """Reconciles the index with Tarjoushaukka every interval seconds."""
+    while True:
+        try:
+            await reconcile(index)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Subscription reconciliation failed: {repr(e)}")
+        await asyncio.sleep(interval)
+
+
+async def run_replay(index: SubscriptionIndex, interval: float):
+    """Retries unsynced changes every interval seconds until Tarjoushaukka is back."""
+    while True:
+        await asyncio.sleep(interval)
+        if index.unsynced:
+            pushed = await replay(index)
+            if pushed:
+                logger.info(f"Replayed {pushed} subscription changes to Tarjoushaukka")
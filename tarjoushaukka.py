@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+import settings
+from categories import ALL_CATEGORIES, CATEGORY_IDS, category_bit, names_from_mask
+from circuit_breaker import breaker
+from http_client import get_client
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = httpx.Timeout(settings.TARJOUSHAUKKA_TIMEOUT, connect=settings.TARJOUSHAUKKA_CONNECT_TIMEOUT)
+
+BREAKER = breaker("tarjoushaukka")
+
+# Delay before the first retry, doubled on each one after it
+RETRY_BACKOFF = 0.5
+
+
+class TarjoushaukkaError(Exception):
+    pass
+
+
+async def request(method: str, path: str, **kwargs) -> httpx.Response:
+    """Sends a request to Tarjoushaukka, retrying connection errors and 5xx responses.
+
+    Only used for idempotent calls, so a retried request that did reach the
+    backend is harmless.
+    """
+    if not BREAKER.allow():
+        raise TarjoushaukkaError(f"{method} {path}: Tarjoushaukka is unavailable")
+    started = time.monotonic()
+    ok = None
+    try:
+        response = await request_with_retries(method, path, **kwargs)
+        ok = True
+    except TarjoushaukkaError:
+        ok = False
+        raise
+    finally:
+        BREAKER.record(started, ok)
+
+    # Client errors mean Tarjoushaukka is up and answering
+    if not response.is_success:
+        raise TarjoushaukkaError(f"{method} {path}: HTTP {response.status_code}")
+    return response
+
+
+async def request_with_retries(method: str, path: str, **kwargs) -> httpx.Response:
+    url = f"{settings.TARJOUSHAUKKA_URL}{path}"
+    error = None
+    for attempt in range(settings.TARJOUSHAUKKA_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            response = await get_client().request(method, url, timeout=TIMEOUT, **kwargs)
+        except httpx.TransportError as e:
+            error = e
+            continue
+        if response.status_code >= 500:
+            error = f"HTTP {response.status_code}"
+            continue
+        return response
+    raise TarjoushaukkaError(f"{method} {path}: {error!r}")
+
+
+def mask_from_remote(categories: list) -> int:
+    # Tarjoushaukka stores a subscription to every category as an empty list
+    if not categories:
+        return ALL_CATEGORIES
+    mask = 0
+    for category in categories:
+        if category in CATEGORY_IDS:
+            mask |= category_bit(CATEGORY_IDS[category])
+        else:
+            logger.warning(f"Unknown category from Tarjoushaukka: {category}")
+    return mask
+
+
+def parse_subscriptions(payload) -> dict:
+    """Turns a GET /chat payload into a chat to category mask mapping.
+
+    Raises TarjoushaukkaError if it isn't a list of chats with their
+    categories, a missing list would otherwise read as every category.
+    """
+    if not isinstance(payload, list):
+        raise TarjoushaukkaError(f"GET /chat: expected a list, got {type(payload).__name__}")
+    subscriptions = {}
+    for chat in payload:
+        if not isinstance(chat, dict) or not isinstance(chat.get("categories"), list):
+            raise TarjoushaukkaError(f"GET /chat: unexpected chat {chat!r}")
+        try:
+            chat_id = int(chat["chat-id"])
+        except (KeyError, TypeError, ValueError):
+            raise TarjoushaukkaError(f"GET /chat: unexpected chat {chat!r}")
+        subscriptions[chat_id] = mask_from_remote(chat["categories"])
+    return subscriptions
+
+
+async def fetch_subscriptions() -> dict:
+    """Returns Tarjoushaukka's subscriptions as a chat to category mask mapping."""
+    response = await request("GET", "/chat")
+    try:
+        payload = response.json()
+    except ValueError:
+        raise TarjoushaukkaError("GET /chat: response is not JSON")
+    return parse_subscriptions(payload)
+
+
+async def subscribe(chat_id: int, mask: int):
+    data = {
+        "chat-id": chat_id,
+        "categories": [] if mask == ALL_CATEGORIES else names_from_mask(mask),
+        "sub-type": "subscribe",
+    }
+    await request("POST", "/chat", data=data)
+
+
+async def unsubscribe(chat_id: int):
+    data = {
+        "chat-id": chat_id,
+        "sub-type": "unsubscribe",
+    }
+    await request("POST", "/chat", data=data)
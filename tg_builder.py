@@ -1,10 +1,18 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+from http import HTTPStatus
 from typing import Collection, Optional, TypeVar, Union
 
 import httpx
 from telegram._utils.defaultvalue import DefaultValue
 from telegram._utils.types import HTTPVersion, SocketOpt
+from telegram.error import TelegramError
 from telegram.ext import ApplicationBuilder
-from telegram.request import BaseRequest, HTTPXRequest
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
+
+from rate_limit import TokenBucket
 
 BuilderType = TypeVar("BuilderType", bound="ApplicationBuilder")
 
@@ -14,6 +22,137 @@ WRITE_TIMEOUT = 30
 CONNECT_TIMEOUT = 30
 POOL_TIMEOUT = 10
 
+# Telegram's limits: 30 messages per second overall, one message per second
+# to a private chat and 20 messages per minute to a group. Groups may burst
+# a little so a couple of quick replies in a row aren't held back.
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+
+MAX_CHAT_BUCKETS = 1000
+
+# Calls that post a message to a chat, the ones Telegram's limits count.
+# Edits, deletions and chat actions don't go through the buckets.
+MESSAGE_METHODS = frozenset(
+    {
+        "sendMessage",
+        "sendPhoto",
+        "sendAnimation",
+        "sendAudio",
+        "sendDocument",
+        "sendVideo",
+        "sendVideoNote",
+        "sendVoice",
+        "sendSticker",
+        "sendMediaGroup",
+        "sendLocation",
+        "sendVenue",
+        "sendContact",
+        "sendPoll",
+        "sendDice",
+        "sendInvoice",
+        "copyMessage",
+        "copyMessages",
+        "forwardMessage",
+        "forwardMessages",
+    }
+)
+
+# Set while sending background messages like alerts, which only use spare tokens
+BACKGROUND = contextvars.ContextVar("background", default=False)
+
+# A 429 is waited out and retried this many times when Telegram asks for at
+# most MAX_RETRY_AFTER seconds, longer waits are left to the caller
+MAX_FLOOD_RETRIES = 3
+MAX_RETRY_AFTER = 60
+
+
+class FloodControl:
+    """Token buckets for sending messages, shared by every TGRequest.
+
+    Messages wait for a token from the chat's bucket and the global one
+    instead of failing, other calls aren't limited. Background messages
+    wait until a token is spare, so a backlog of them doesn't delay replies.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(rate=GLOBAL_RATE, capacity=GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.waiting = 0
+        self.max_waiting = 0
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.flood_waits = 0
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                for idle_chat_id in [c for c, b in self.chat_buckets.items() if b.idle]:
+                    del self.chat_buckets[idle_chat_id]
+
+            # Group and channel chat IDs are negative, channels may also be @usernames
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(rate=PRIVATE_CHAT_RATE, capacity=1)
+            else:
+                bucket = TokenBucket(rate=GROUP_CHAT_RATE, capacity=GROUP_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id, background: bool = False):
+        self.requests += 1
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        started = time.monotonic()
+        try:
+            if background:
+                await self.chat_bucket(chat_id).acquire_spare()
+                await self.global_bucket.acquire_spare()
+            else:
+                await self.chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.throttled += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def pause(self, chat_id, seconds: float):
+        """Holds back calls to the chat after Telegram answered 429 Too Many Requests."""
+        self.flood_waits += 1
+        self.chat_bucket(chat_id).pause(seconds)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "avg_wait": self.wait_time / self.throttled if self.throttled else 0.0,
+            "max_wait": self.max_wait,
+            "flood_waits": self.flood_waits,
+            "chat_buckets": len(self.chat_buckets),
+        }
+
+
+FLOOD_CONTROL = FloodControl()
+
+
+@contextlib.contextmanager
+def background_messages():
+    """Marks the messages sent in the block as background ones."""
+    token = BACKGROUND.set(True)
+    try:
+        yield
+    finally:
+        BACKGROUND.reset(token)
+
 
 class TGRequest(HTTPXRequest):
     def __init__(
@@ -42,6 +181,39 @@ class TGRequest(HTTPXRequest):
         transport = httpx.AsyncHTTPTransport(retries=5)
         self._client._transport = transport
 
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        **timeouts,
+    ) -> tuple:
+        """Rate limits messages to chats and retries calls Telegram throttled."""
+        chat_id = request_data.parameters.get("chat_id") if request_data else None
+        limited = chat_id is not None and url.rpartition("/")[2] in MESSAGE_METHODS
+        for attempt in range(MAX_FLOOD_RETRIES + 1):
+            if limited:
+                await FLOOD_CONTROL.acquire(chat_id, BACKGROUND.get())
+            code, payload = await super().do_request(url, method, request_data, **timeouts)
+            if code != HTTPStatus.TOO_MANY_REQUESTS or attempt == MAX_FLOOD_RETRIES:
+                return code, payload
+
+            retry_after = self.parse_retry_after(payload)
+            if retry_after is None or retry_after > MAX_RETRY_AFTER:
+                return code, payload
+            if limited:
+                FLOOD_CONTROL.pause(chat_id, retry_after)
+            else:
+                FLOOD_CONTROL.flood_waits += 1
+                await asyncio.sleep(retry_after)
+        return code, payload
+
+    def parse_retry_after(self, payload: bytes) -> Optional[float]:
+        try:
+            return self.parse_json_payload(payload)["parameters"]["retry_after"]
+        except (TelegramError, KeyError, TypeError):
+            return None
+
 
 class TGBuilder(ApplicationBuilder):
     def request(self: BuilderType, request: BaseRequest) -> BuilderType:
@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class AdaptiveSampler:
+    """Sentry traces_sampler that keeps each route and handler near target_per_minute traces.
+
+    Rare transactions are always traced, frequent ones at a rate scaled down
+    by how often they occurred in the current or previous minute.
+    """
+
+    def __init__(self, target_per_minute: float):
+        self.target = target_per_minute
+        self.counts = {}
+        self.previous_counts = {}
+        self.window_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __call__(self, sampling_context: dict) -> float:
+        # Keep distributed traces whole
+        parent_sampled = sampling_context.get("parent_sampled")
+        if parent_sampled is not None:
+            return float(parent_sampled)
+
+        name = sampling_context.get("transaction_context", {}).get("name", "")
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.previous_counts = self.counts
+                self.counts = {}
+                self.window_start = now
+            count = self.counts[name] = self.counts.get(name, 0) + 1
+            expected = max(count, self.previous_counts.get(name, 0))
+        return min(1.0, self.target / expected)
+
+    def stats(self) -> dict:
+        return {name: min(1.0, self.target / count) for name, count in self.previous_counts.items()}
@@ -0,0 +1,86 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def ordering_key(update: object):
+    """Updates with the same key are handled in arrival order, None means any order."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    # Buttons on messages sent via inline mode have no chat
+    if update.callback_query is not None and update.callback_query.inline_message_id:
+        return update.callback_query.inline_message_id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates from different chats concurrently and updates from one chat in order.
+
+    PTB's own semaphore only bounds how many updates may be pending. The
+    concurrency limit is applied after an update's turn in its chat has
+    come, so updates queued behind a slow one in the same chat don't take
+    up slots other chats could use. Each chat's lock exists only while the
+    chat has updates pending.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        super().__init__(max_pending_updates)
+        self.limit = asyncio.Semaphore(max_concurrent_updates)
+        self.max_running = max_concurrent_updates
+        self.chat_locks = {}
+        self.chat_pending = {}
+        self.running = 0
+        self.handled = 0
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = ordering_key(update)
+        try:
+            if key is None:
+                await self.run(coroutine)
+            else:
+                await self.run_in_order(key, coroutine)
+        finally:
+            # Cancelled while waiting, nothing else would close the coroutine
+            coroutine.close()
+
+    async def run_in_order(self, key, coroutine):
+        lock = self.chat_locks.get(key)
+        if lock is None:
+            lock = self.chat_locks[key] = asyncio.Lock()
+        self.chat_pending[key] = self.chat_pending.get(key, 0) + 1
+        try:
+            async with lock:
+                await self.run(coroutine)
+        finally:
+            self.chat_pending[key] -= 1
+            if not self.chat_pending[key]:
+                del self.chat_pending[key]
+                del self.chat_locks[key]
+
+    async def run(self, coroutine):
+        async with self.limit:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.handled += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "max_running": self.max_running,
+            "pending": self.current_concurrent_updates,
+            "max_pending": self.max_concurrent_updates,
+            "chats": len(self.chat_locks),
+            "handled": self.handled,
+        }
@@ -0,0 +1,36 @@
+import hmac
+import threading
+from collections import OrderedDict
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def is_valid_secret(token, secret: str) -> bool:
+    return token is not None and hmac.compare_digest(token.encode(), secret.encode())
+
+
+class RecentUpdates:
+    """Remembers the latest update IDs so updates Telegram redelivers are dropped."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.duplicates = 0
+        self._ids = OrderedDict()
+
+    def seen(self, update_id: int) -> bool:
+        """Records the update ID and returns whether it was already recorded. Thread safe."""
+        with self.lock:
+            if update_id in self._ids:
+                self.duplicates += 1
+                return True
+            self._ids[update_id] = None
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return False
+
+    def stats(self) -> dict:
+        return {
+            "remembered": len(self._ids),
+            "duplicates": self.duplicates,
+        }